@@ -8,13 +8,20 @@
 #  - documentation
 
 import csv
+import hashlib
+import io
 import os
 import logging
-import tempfile
 import odoo
 import shutil
+import subprocess
+import tarfile
+import time
+import zipfile
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from manifestoo_core import core_addons, odoo_series
 
 import click
@@ -27,24 +34,296 @@ README = """
 - addons.csv: describes all addons in addons directory, where they came from and author
 - addons/: directory containing all addon source code
 - odoo.conf: production odoo configuration
+- MANIFEST.sha256: sha256 of every file, check them with `sha256sum -c`
+- DELETED.txt: only in delta exports, files deleted since the previous export
 """
 
+MANIFEST = "MANIFEST.sha256"
+DELETED = "DELETED.txt"
+ADDONS_PATH = "/opt/odoo/auto/addons"
+PRIVATE_PATH = "/opt/odoo/custom/src/private"
+ODOO_CONF = "/opt/odoo/auto/odoo.conf"
+
 
 OdooModule = namedtuple("OdooModule", [
     'name', 'origin', 'dependencies', 'license', 'author'
 ])
 
-SUPPORTED_FORMATS = {
-    "tar.gz": "gztar",
-    "zip": "zip",
+SUPPORTED_FORMATS = ("tar.gz", "tar.zst", "zip")
+
+# Multi-threaded compressors for tar archives, used when installed
+COMPRESSORS = {
+    "tar.gz": ["pigz", "--processes", str(os.cpu_count() or 1), "-c"],
+    "tar.zst": ["zstd", "-T0", "-q", "-c"],
 }
 
 
+class ArchiveWriter:
+    """Stream files into a tar or zip archive, following symlinks."""
+
+    def __init__(self, path, archive_format):
+        self.process = None
+        command = COMPRESSORS.get(archive_format)
+        if command and not shutil.which(command[0]):
+            if archive_format != "tar.gz":
+                raise click.ClickException(f"{command[0]} is needed for {archive_format} archives")
+            _logger.info("pigz not found, compressing with a single thread")
+            command = None
+        self.output = open(path, "wb")
+        try:
+            if archive_format == "zip":
+                self.archive = zipfile.ZipFile(self.output, "w", zipfile.ZIP_DEFLATED)
+            elif command:
+                self.process = subprocess.Popen(
+                    command, stdin=subprocess.PIPE, stdout=self.output
+                )
+                self.archive = tarfile.open(
+                    fileobj=self.process.stdin, mode="w|", dereference=True
+                )
+            else:
+                self.archive = tarfile.open(
+                    fileobj=self.output, mode="w|gz", dereference=True
+                )
+        except BaseException:
+            self.output.close()
+            os.remove(path)
+            raise
+
+    def add_file(self, path, arcname):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.write(path, arcname)
+            return
+        info = self.archive.gettarinfo(path, arcname)
+        with open(path, "rb") as f:
+            self.archive.addfile(info, f)
+
+    def add_bytes(self, data, arcname):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(arcname, data)
+            return
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        try:
+            self.archive.close()
+            if self.process:
+                self.process.stdin.close()
+                if self.process.wait():
+                    raise click.ClickException("Compressing the archive failed")
+        finally:
+            self.output.close()
+
+
+class Progress:
+    """Log how many files and bytes were archived, and how fast."""
+
+    def __init__(self, total_files, total_bytes, interval=2):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = self.logged = time.time()
+
+    def update(self, size):
+        self.files += 1
+        self.bytes += size
+        if time.time() - self.logged >= self.interval or self.files == self.total_files:
+            self.log()
+
+    def log(self):
+        self.logged = time.time()
+        _logger.info(
+            "Archived %d/%d files, %.1f/%.1f MiB (%.1f MiB/s)",
+            self.files,
+            self.total_files,
+            self.bytes / 2**20,
+            self.total_bytes / 2**20,
+            self.bytes / 2**20 / max(self.logged - self.start, 0.001),
+        )
+
+
+def _read_archive(path):
+    """Yield `(arcname, file object)` of every file in an archive."""
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as f:
+                        yield info.filename, f
+        return
+    process = None
+    if path.endswith(".tar.zst"):
+        process = subprocess.Popen(["zstd", "-dcq", path], stdout=subprocess.PIPE)
+        archive = tarfile.open(fileobj=process.stdout, mode="r|")
+    else:
+        archive = tarfile.open(path, mode="r|*")
+    try:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
+    finally:
+        archive.close()
+        if process:
+            process.kill()
+            process.wait()
+
+
+def _parse_manifest(content):
+    """Parse `sha256sum` output into a dict of hashes by path."""
+    manifest = {}
+    for line in content.splitlines():
+        if line.strip():
+            sha, arcname = line.split("  ", 1)
+            manifest[arcname] = sha
+    return manifest
+
+
+def _read_manifest(path):
+    """Read the manifest of a previous export, or a manifest file."""
+    if not path.endswith((".zip", ".tar.gz", ".tar.zst")):
+        with open(path) as f:
+            return _parse_manifest(f.read())
+    for arcname, f in _read_archive(path):
+        if arcname == MANIFEST:
+            return _parse_manifest(f.read().decode())
+    raise click.ClickException(f"{path} has no {MANIFEST}")
+
+
+def _sha256(f):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(2**20), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sha256_file(path):
+    with open(path, "rb") as f:
+        return _sha256(f)
+
+
+def verify(path):
+    """Check the files of an archive against the manifest it contains."""
+    manifest, found, errors = None, set(), []
+    deleted = None
+    for arcname, f in _read_archive(path):
+        if arcname == MANIFEST:
+            manifest = _parse_manifest(f.read().decode())
+            continue
+        if arcname == DELETED:
+            deleted = f.read().decode().splitlines()
+            continue
+        if manifest is None:
+            raise click.ClickException(f"{MANIFEST} is not the first file of {path}")
+        found.add(arcname)
+        if arcname not in manifest:
+            errors.append(f"{arcname}: not in the manifest")
+        elif _sha256(f) != manifest[arcname]:
+            errors.append(f"{arcname}: hash mismatch")
+    if manifest is None:
+        raise click.ClickException(f"{path} has no {MANIFEST}")
+    # Delta exports only contain the files changed since the previous export
+    if deleted is None:
+        errors.extend(f"{arcname}: missing" for arcname in sorted(set(manifest) - found))
+    for error in errors:
+        _logger.error(error)
+    if errors:
+        raise click.ClickException(f"{path} failed verification")
+    _logger.info(
+        "%s verified: %d files%s", path, len(found), " (delta export)" if deleted is not None else ""
+    )
+
+
+def fetch_installed_modules(cr, exclude=()):
+    """Return the installed modules not in `exclude`, in two SQL queries.
+
+    Works with any cursor, i.e. `env.cr` or a plain database cursor, so no
+    Odoo registry needs to be loaded.
+    """
+    exclude = list(exclude)
+    cr.execute(
+        """
+        SELECT m.id, m.name, m.website, m.license, m.author
+        FROM ir_module_module m
+        WHERE m.state = 'installed' AND NOT m.name = ANY(%s)
+        ORDER BY m.name
+        """,
+        (exclude,),
+    )
+    modules = cr.fetchall()
+    cr.execute(
+        """
+        SELECT d.module_id, d.name
+        FROM ir_module_module_dependency d
+        JOIN ir_module_module m ON m.id = d.module_id
+        WHERE m.state = 'installed' AND NOT m.name = ANY(%s)
+        ORDER BY d.id
+        """,
+        (exclude,),
+    )
+    dependencies = {}
+    for module_id, name in cr.fetchall():
+        dependencies.setdefault(module_id, []).append(name)
+    result = []
+    for module_id, name, website, license, author in modules:
+        maybe_private_module_path = os.path.exists(os.path.join(PRIVATE_PATH, name))
+        result.append(
+            OdooModule(
+                name,
+                website if not maybe_private_module_path else "customer specific module",
+                ",".join(dependencies.get(module_id, [])),
+                license,
+                author,
+            )
+        )
+    return result
+
+
+def _addon_files(name):
+    """Yield `(path, arcname)` of every file of an addon, following symlinks."""
+    root = os.path.join(ADDONS_PATH, name)
+    if not os.path.isdir(root):
+        raise click.ClickException(f"{name} is installed, but not found in {ADDONS_PATH}")
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield path, os.path.join("addons", name, os.path.relpath(path, root))
+
+
 # ./export-thing.py --path=/var/lib/odoo/export.zip
 @click.command()
-@click_odoo.env_options(default_log_level="info")
+# Module metadata is read with plain SQL, no Odoo environment is needed. The
+# database option is ours, click_odoo would load the registry for its own one,
+# and it drops any "database" parameter, hence the "database_name" destination.
+@click_odoo.env_options(default_log_level="info", with_database=False)
+@click.option(
+    "--database",
+    "-d",
+    "database_name",
+    envvar=["PGDATABASE"],
+    help="Database to export the modules of. Defaults to the one in the Odoo "
+    "configuration file",
+)
 @click.option("--path", help="Path to archive file")
-def main(env, path):
+@click.option(
+    "--previous",
+    help="Previous export or manifest. Only files added or changed since then are "
+    "exported, and deleted files are listed in DELETED.txt",
+)
+@click.option(
+    "--verify",
+    "verify_path",
+    help="Check the files of an export against its manifest, instead of exporting",
+)
+def main(env, database_name, path, previous, verify_path):
+    if verify_path:
+        verify(verify_path)
+        return
+
     if not path:
         _logger.critical("No export path provided")
         return
@@ -61,58 +340,83 @@ def main(env, path):
         os.path.basename(path).split(".", 1)
     )
     if split_ext not in SUPPORTED_FORMATS:
-        _logger.critical("Format not in supported list: %s", ", ".join(SUPPORTED_FORMATS.keys()))
+        _logger.critical("Format not in supported list: %s", ", ".join(SUPPORTED_FORMATS))
         return
 
-    modules_to_export = []
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        modules_to_exclude = list(core_addons.get_core_addons(
-            odoo_series.OdooSeries.from_str(odoo.release.version.split("+")[0])
-        ))
-        modules_to_exclude.extend(["studio_customization"])
-
-        for module_id in env['ir.module.module'].search([
-            ('state', '=', 'installed'),
-            ('name', 'not in', modules_to_exclude)
-        ]):
-            maybe_private_module_path = os.path.exists(f"/opt/odoo/custom/src/private/{module_id.name}")
-
-            modules_to_export.append(
-                OdooModule(
-                    module_id.name,
-                    module_id.website if not maybe_private_module_path else "customer specific module",
-                    ",".join(module_id.dependencies_id.mapped('name')),
-                    module_id.license,
-                    module_id.author,
-                )
-            )
+    database = database_name or odoo.tools.config["db_name"]
+    if not database:
+        _logger.critical("No database provided")
+        return
 
-        export_csv = os.path.join(tmpdir, "addons.csv")
-        export_addons = os.path.join(tmpdir, "addons")
-        os.mkdir(export_addons)
-        with open(export_csv, "w") as f:
-            writer = csv.DictWriter(f, fieldnames=OdooModule._fields)
-            writer.writeheader()
-            for i in modules_to_export:
-                writer.writerow(i._asdict())
-
-                shutil.copytree(
-                    f"/opt/odoo/auto/addons/{i.name}",
-                    f"{export_addons}/{i.name}"
-                )
+    modules_to_exclude = list(core_addons.get_core_addons(
+        odoo_series.OdooSeries.from_str(odoo.release.version.split("+")[0])
+    ))
+    modules_to_exclude.extend(["studio_customization"])
+
+    with closing(odoo.sql_db.db_connect(database).cursor()) as cr:
+        modules_to_export = fetch_installed_modules(cr, modules_to_exclude)
 
-        readme = os.path.join(tmpdir, "README.md")
-        with open(readme, "w") as f:
-            f.write(README)
+    addons_csv = io.StringIO()
+    writer = csv.DictWriter(addons_csv, fieldnames=OdooModule._fields)
+    writer.writeheader()
+    files = []
+    for i in modules_to_export:
+        writer.writerow(i._asdict())
+        files.extend(_addon_files(i.name))
+    files.append((ODOO_CONF, "odoo.conf"))
+    generated = {
+        "addons.csv": addons_csv.getvalue().encode(),
+        "README.md": README.encode(),
+    }
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        hashes = executor.map(_sha256_file, (f for f, _ in files))
+        manifest = dict(zip((arcname for _, arcname in files), hashes))
+    manifest.update(
+        (arcname, hashlib.sha256(data).hexdigest()) for arcname, data in generated.items()
+    )
+    deleted = None
+    if previous:
+        previous_manifest = _read_manifest(previous)
+        deleted = sorted(set(previous_manifest) - set(manifest))
+        files = [f for f in files if previous_manifest.get(f[1]) != manifest[f[1]]]
+        generated = {
+            arcname: data
+            for arcname, data in generated.items()
+            if previous_manifest.get(arcname) != manifest[arcname]
+        }
+        _logger.info(
+            "Delta export: %d changed files, %d deleted files",
+            len(files) + len(generated),
+            len(deleted),
+        )
 
-        shutil.copy("/opt/odoo/auto/odoo.conf", tmpdir)
-        output_file_name = shutil.make_archive(
-            os.path.join(os.path.dirname(path), split_path),
-            SUPPORTED_FORMATS[split_ext],
-            tmpdir
+    progress = Progress(len(files), sum(os.path.getsize(f) for f, _ in files))
+    archive = ArchiveWriter(path, split_ext)
+    try:
+        # The manifest goes first, so that it can be read without the whole archive
+        archive.add_bytes(
+            "".join(f"{sha}  {arcname}\n" for arcname, sha in sorted(manifest.items())).encode(),
+            MANIFEST,
         )
-        _logger.info("Created %s", output_file_name)
+        if deleted is not None:
+            archive.add_bytes("".join(f"{arcname}\n" for arcname in deleted).encode(), DELETED)
+        for arcname, data in generated.items():
+            archive.add_bytes(data, arcname)
+        for file_path, arcname in files:
+            archive.add_file(file_path, arcname)
+            progress.update(os.path.getsize(file_path))
+        archive.close()
+    except BaseException:
+        # Never leave a partial archive behind, even if closing it fails too
+        try:
+            archive.close()
+        except Exception:
+            _logger.debug("Could not close the partial archive", exc_info=True)
+        finally:
+            os.remove(path)
+        raise
+    _logger.info("Created %s", path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Keep Odoo imported in a long-lived process and run the test jobs submitted
+# by `invoke test` through a spool directory:
+#  - jobs/<id>.json: job to run, written by the host
+#  - <id>.log: log of the job, tailed by the host
+#  - <id>.result: exit status of the job
+#  - heartbeat: touched every second while the daemon is alive, even during jobs
+#
+# Any odoo command line option is accepted, i.e. `test_daemon.py -d devel`.
+# The daemon exits with STALE_EXIT_CODE as soon as any Python file it
+# imported changes, so that the host can start a fresh one.
+
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import odoo
+
+_logger = logging.getLogger("test_daemon")
+
+SPOOL = "/opt/odoo/auto/test-daemon"
+STALE_EXIT_CODE = 3
+# Same format as odoo's own log lines, so they can be parsed the same way
+LOG_FORMAT = "%(asctime)s %(pid)s %(levelname)s %(dbname)s %(name)s: %(message)s"
+
+
+def _imported_files(files=None):
+    """Record the mtime of every imported Python file not seen before."""
+    files = dict(files or {})
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and path.startswith("/opt/odoo/") and path not in files:
+            try:
+                files[path] = os.stat(path).st_mtime
+            except OSError:
+                files[path] = None
+    return files
+
+
+def _stale_file(files):
+    for path, mtime in files.items():
+        try:
+            current = os.stat(path).st_mtime
+        except OSError:
+            current = None
+        if current != mtime:
+            return path
+    return None
+
+
+def _write_json(path, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def _beat(heartbeat, stop):
+    """Touch `heartbeat` every second until `stop` is set."""
+    while not stop.is_set():
+        with open(heartbeat, "w") as f:
+            f.write(str(os.getpid()))
+        stop.wait(1)
+
+
+def _default_database():
+    return odoo.tools.config["db_name"] or os.environ.get("PGDATABASE")
+
+
+def run_job(job, log_path):
+    """Run a test job in a fresh registry, like `odoo --stop-after-init`."""
+    config = odoo.tools.config
+    config["test_enable"] = True
+    config["init"] = {}
+    config["update"] = {}
+    config[job["mode"]] = dict.fromkeys(job["modules"], 1)
+    if "test_tags" in config.options:
+        config["test_tags"] = job.get("test_tags")
+    database = job.get("database") or _default_database()
+    handler = logging.FileHandler(log_path)
+    handler.setFormatter(odoo.netsvc.DBFormatter(LOG_FORMAT))
+    logging.getLogger().addHandler(handler)
+    try:
+        odoo.modules.registry.Registry.delete(database)
+        return odoo.service.server.preload_registries([database])
+    except Exception:
+        _logger.exception("Test job %s failed", job["id"])
+        return 1
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+
+def main():
+    odoo.tools.config.parse_config(sys.argv[1:])
+    os.makedirs(os.path.join(SPOOL, "jobs"), exist_ok=True)
+    heartbeat = os.path.join(SPOOL, "heartbeat")
+    odoo.service.server.load_server_wide_modules()
+    # Warm up the registry, which imports the code of all installed addons
+    if _default_database():
+        odoo.modules.registry.Registry(_default_database())
+    files = _imported_files()
+    _logger.info("Test daemon ready, watching %d files", len(files))
+    # Beat from a thread, so that long jobs don't look like a dead daemon
+    stop = threading.Event()
+    beat = threading.Thread(target=_beat, args=(heartbeat, stop), daemon=True)
+    beat.start()
+    while True:
+        jobs = sorted(glob.glob(os.path.join(SPOOL, "jobs", "*.json")))
+        if not jobs:
+            time.sleep(0.2)
+            continue
+        with open(jobs[0]) as f:
+            job = json.load(f)
+        os.remove(jobs[0])
+        result_path = os.path.join(SPOOL, "{}.result".format(job["id"]))
+        stale = _stale_file(files)
+        if stale:
+            _logger.info("%s changed, exiting", stale)
+            _write_json(result_path, {"status": "stale", "file": stale})
+            stop.set()
+            beat.join()
+            os.remove(heartbeat)
+            sys.exit(STALE_EXIT_CODE)
+        start = time.time()
+        rc = run_job(job, os.path.join(SPOOL, "{}.log".format(job["id"])))
+        _write_json(
+            result_path,
+            {
+                "status": "done",
+                "exit_code": 1 if rc else 0,
+                "time": time.time() - start,
+            },
+        )
+        files = _imported_files(files)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,35 +3,99 @@ This file is to be executed with https://www.pyinvoke.org/ in Python 3.6+.
 
 Contains common helpers to develop using this project.
 """
+import ast
+import fcntl
+import hashlib
+import json
 import os
+import re
+import shlex
 import shutil
+import socket
+import subprocess
+import sys
 import tempfile
+import threading
 import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fnmatch import fnmatch
 from logging import getLogger
 from pathlib import Path
 
-from invoke import exceptions, task
+from invoke import Context, Task, exceptions
+from invoke import task as _invoke_task
 from invoke.util import yaml
 
 PROJECT_ROOT = Path(__file__).parent.absolute()
 SRC_PATH = PROJECT_ROOT / "odoo" / "custom" / "src"
+REPOS_LOCK_FILE = SRC_PATH / "repos.lock"
+# What was last aggregated in this checkout, kept out of the committed lockfile
+REPOS_STATE_FILE = PROJECT_ROOT / "odoo" / "auto" / "repos-state.json"
+# Host-wide bare mirrors of aggregated remotes, shared by all projects
+GIT_MIRRORS_PATH = Path(
+    os.environ.get(
+        "GIT_MIRRORS_PATH", Path.home() / ".cache" / "odoo-scaffolding" / "git-mirrors"
+    )
+)
 UID_ENV = {"GID": str(os.getgid()), "UID": str(os.getuid()), "UMASK": "27"}
-SERVICES_WAIT_TIME = int(os.environ.get("SERVICES_WAIT_TIME", 1))
+# Proxies in front of a service, which must be restarted when it changes
+PROXY_SERVICES = {"odoo": ("ha_proxy", "odoo_proxy")}
+# SERVICES_WAIT_TIME is the deprecated name of SERVICES_READY_TIMEOUT
+SERVICES_READY_TIMEOUT = float(
+    os.environ.get("SERVICES_READY_TIMEOUT", os.environ.get("SERVICES_WAIT_TIME", 120))
+)
 ODOO_VERSION = float(
     yaml.safe_load((PROJECT_ROOT / "devel.yaml").read_text())["services"]["odoo"][
         "build"
     ]["args"]["ODOO_VERSION"]
 )
+MANIFESTS = ("__manifest__.py", "__openerp__.py")
+# Special addon repositories, as understood by doodba's `addons` script
+CORE = "odoo/addons"
+ENTERPRISE = "enterprise"
+PRIVATE = "private"
+ADDONS_INDEX_FILE = PROJECT_ROOT / "odoo" / "auto" / "addons-index.json"
+ADDONS_INDEX_VERSION = 2
+TEST_TEMPLATES_FILE = PROJECT_ROOT / "odoo" / "auto" / "test-templates.json"
+TEST_DAEMON_PATH = PROJECT_ROOT / "odoo" / "auto" / "test-daemon"
+TEST_DAEMON_CONTAINER = "{}-test-daemon".format(PROJECT_ROOT.name)
+TEST_TEMPLATES_MAX = int(os.environ.get("TEST_TEMPLATES_MAX", 5))
+TIMINGS_FILE = PROJECT_ROOT / "odoo" / "auto" / "timings.jsonl"
+TIMINGS_MAX_RECORDS = int(os.environ.get("TIMINGS_MAX_RECORDS", 20000))
+TEST_LOGS_PATH = PROJECT_ROOT / "odoo" / "auto" / "test-logs"
+TEST_HISTORY_FILE = PROJECT_ROOT / "odoo" / "auto" / "test-history.jsonl"
+TEST_HISTORY_RUNS = int(os.environ.get("TEST_HISTORY_RUNS", 50))
+COVERAGE_CONTEXTS_RCFILE = PROJECT_ROOT / "odoo" / "auto" / ".coveragerc-contexts"
+UPGRADE_LOGS_PATH = PROJECT_ROOT / "odoo" / "auto" / "upgrade-logs"
+UPGRADE_HISTORY_FILE = PROJECT_ROOT / "odoo" / "auto" / "upgrade-history.jsonl"
 DB_USER = yaml.safe_load((PROJECT_ROOT / "devel.yaml").read_text())["services"]["odoo"][
     "environment"
 ]["PGUSER"]
+DB_NAME = yaml.safe_load((PROJECT_ROOT / "devel.yaml").read_text())["services"]["odoo"][
+    "environment"
+]["PGDATABASE"]
+SNAPSHOTS_PATH = PROJECT_ROOT / "odoo" / "auto" / "snapshots"
+IMAGE_HASH_LABEL = "odoo-scaffolding.build-hash"
+IMAGE_PROJECT_LABEL = "odoo-scaffolding.project"
+BUILD_CACHE_PATH = Path(
+    os.environ.get(
+        "BUILD_CACHE_PATH",
+        Path.home() / ".cache" / "odoo-scaffolding" / "buildkit" / PROJECT_ROOT.name,
+    )
+)
+# BuildKit builder able to export cache, which the default one can't do
+BUILDX_BUILDER = "odoo-scaffolding"
 
 
 _logger = getLogger(__name__)
 
 
 def _override_docker_env(database=False):
-    extra_env = UID_ENV
+    extra_env = dict(UID_ENV)
     if database and isinstance(database, str):
         extra_env["PGDATABASE"] = database
     return extra_env
@@ -46,6 +110,142 @@ def _override_docker_command(service, command, file):
     file.flush()
 
 
+class _Tee:
+    """File-like object writing to several streams at once."""
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+_timings_lock = threading.Lock()
+# Top level task being timed, and its invocation id
+_timings_state = {"task": None, "run": None}
+
+
+def _write_timing(record):
+    line = json.dumps(record, sort_keys=True) + "\n"
+    try:
+        with _timings_lock:
+            TIMINGS_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(TIMINGS_FILE), "a") as fd:
+                fd.write(line)
+            # Keep only the most recent records when a task finishes
+            if record["kind"] == "task" and record["name"] == record["task"]:
+                with open(str(TIMINGS_FILE)) as fd:
+                    records = fd.readlines()
+                if len(records) > TIMINGS_MAX_RECORDS:
+                    tmp_file = TIMINGS_FILE.with_suffix(".tmp")
+                    with open(str(tmp_file), "w") as fd:
+                        fd.writelines(records[-TIMINGS_MAX_RECORDS:])
+                    os.replace(str(tmp_file), str(TIMINGS_FILE))
+    except OSError:
+        _logger.debug("Could not write timings to %s", TIMINGS_FILE)
+
+
+@contextmanager
+def _timed(kind, name, **extra):
+    """Record wall time and exit code of the enclosed block in TIMINGS_FILE.
+
+    `kind` is one of "task", "phase" or "run" (a command).
+    """
+    record = dict(
+        extra,
+        kind=kind,
+        name=name,
+        task=_timings_state["task"] or name,
+        run=_timings_state["run"],
+        pid=os.getpid(),
+        tid=threading.get_ident(),
+        start=time.time(),
+        exit_code=0,
+    )
+    try:
+        yield record
+    except BaseException as error:
+        result = getattr(error, "result", None)
+        record["exit_code"] = getattr(result, "exited", None) or getattr(
+            error, "code", 1
+        )
+        raise
+    finally:
+        record["duration"] = time.time() - record["start"]
+        _write_timing(record)
+
+
+def _timed_run(run):
+    """Wrap `Context.run` to record the timing of every command."""
+
+    def timed_run(command, **kwargs):
+        name = " ".join(command.split()[:4])
+        with _timed("run", name, command=command) as record:
+            result = run(command, **kwargs)
+            if result is not None:
+                record["exit_code"] = result.exited
+            return result
+
+    timed_run.timed = True
+    return timed_run
+
+
+class _TimedTask(Task):
+    """Task recording the timings of its body and of its commands."""
+
+    def __call__(self, *args, **kwargs):
+        context = args[0] if args else None
+        if isinstance(context, Context) and not getattr(context.run, "timed", False):
+            context.run = _timed_run(context.run)
+        name = self.name.replace("_", "-")
+        top_level = _timings_state["run"] is None
+        if top_level:
+            _timings_state.update(
+                task=name, run="{}-{}".format(os.getpid(), time.time())
+            )
+        try:
+            with _timed("task", name):
+                return super().__call__(*args, **kwargs)
+        finally:
+            if top_level:
+                _timings_state.update(task=None, run=None)
+
+
+def task(*args, **kwargs):
+    """Like `invoke.task`, recording the timings of the task."""
+    kwargs.setdefault("klass", _TimedTask)
+    return _invoke_task(*args, **kwargs)
+
+
+class _Prefixed:
+    """File-like object writing to `stream` with every line prefixed."""
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.pending = ""
+
+    def write(self, data):
+        lines = (self.pending + data.replace("\r\n", "\n")).split("\n")
+        self.pending = lines.pop()
+        if lines:
+            self.stream.write("".join(self.prefix + line + "\n" for line in lines))
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        """Write the last unfinished line, if any."""
+        if self.pending:
+            self.write("\n")
+        self.flush()
+
+
 def _remove_auto_reload(file, orig_file):
     with open(orig_file) as fd:
         orig_docker_config = yaml.safe_load(fd.read())
@@ -58,8 +258,167 @@ def _remove_auto_reload(file, orig_file):
     _override_docker_command("odoo", new_odoo_command, file)
 
 
+def _addon_containers():
+    """Yield directories (relative to `SRC_PATH`) that may contain addons."""
+    for repo in sorted(os.listdir(str(SRC_PATH))):
+        if repo == "odoo":
+            # Odoo core ships its addons in two different places
+            yield CORE
+            yield "odoo/odoo/addons"
+        elif (SRC_PATH / repo).is_dir():
+            yield repo
+
+
+def _addon_fingerprint(path):
+    """Cheap fingerprint of an addon tree, from the path, size and mtime of its files.
+
+    Bytecode is left out, as Odoo writes it inside the addon when loading it.
+    """
+    fingerprint = hashlib.sha1()
+    for root, dirs, files in os.walk(str(path)):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            if name.endswith(".pyc"):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            fingerprint.update(
+                "{} {} {}\n".format(
+                    os.path.relpath(file_path, str(path)), stat.st_size, stat.st_mtime
+                ).encode()
+            )
+    return fingerprint.hexdigest()
+
+
+def _index_addon(container, name):
+    """Parse the manifest of an addon into an index entry, or `None`."""
+    for manifest_name in MANIFESTS:
+        try:
+            with open(str(SRC_PATH / container / name / manifest_name), "rb") as fd:
+                content = fd.read()
+            break
+        except IOError:
+            continue
+    else:
+        return None
+    try:
+        manifest = ast.literal_eval(content.decode("utf-8"))
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        _logger.warning("Could not parse manifest of %s/%s", container, name)
+        manifest = {}
+    return {
+        "name": name,
+        "repo": container,
+        "depends": list(manifest.get("depends", [])),
+        "installable": bool(manifest.get("installable", True)),
+        "version": manifest.get("version"),
+        "hash": _addon_fingerprint(SRC_PATH / container / name),
+    }
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+_addons_index_cache = None
+
+
+def _addons_index():
+    """Return the addon index, keyed by addon path relative to `SRC_PATH`.
+
+    The index is persisted in `odoo/auto/addons-index.json` and refreshed
+    incrementally: containers are only listed again when their mtime changed,
+    and manifests are only parsed again when the mtime of the addon directory
+    or of its manifest changed.
+    """
+    global _addons_index_cache
+    if _addons_index_cache is not None:
+        return _addons_index_cache
+    try:
+        with open(str(ADDONS_INDEX_FILE)) as fd:
+            stored = json.load(fd)
+        if stored.get("version") != ADDONS_INDEX_VERSION:
+            raise ValueError("Outdated addons index")
+    except (IOError, ValueError):
+        stored = {}
+    old_containers = stored.get("containers", {})
+    old_addons = stored.get("addons", {})
+    containers, addons = {}, {}
+    changed = False
+    for container in _addon_containers() if SRC_PATH.is_dir() else ():
+        container_path = str(SRC_PATH / container)
+        mtime = _mtime(container_path)
+        if mtime is None:
+            continue
+        cached = old_containers.get(container)
+        if cached and cached["mtime"] == mtime:
+            children = cached["children"]
+        else:
+            changed = True
+            children = sorted(
+                name
+                for name in os.listdir(container_path)
+                if os.path.isdir(os.path.join(container_path, name))
+            )
+        containers[container] = {"mtime": mtime, "children": children}
+        for name in children:
+            key = "{}/{}".format(container, name)
+            addon_path = os.path.join(container_path, name)
+            stamp = [_mtime(addon_path)] + [
+                _mtime(os.path.join(addon_path, m)) for m in MANIFESTS
+            ]
+            cached = old_addons.get(key)
+            if cached and cached["stamp"] == stamp:
+                addons[key] = cached
+                continue
+            changed = True
+            addons[key] = {"stamp": stamp, "addon": _index_addon(container, name)}
+    if changed or len(addons) != len(old_addons):
+        ADDONS_INDEX_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = ADDONS_INDEX_FILE.with_suffix(".tmp")
+        with open(str(tmp_file), "w") as fd:
+            json.dump(
+                {
+                    "version": ADDONS_INDEX_VERSION,
+                    "containers": containers,
+                    "addons": addons,
+                },
+                fd,
+            )
+        os.replace(str(tmp_file), str(ADDONS_INDEX_FILE))
+    _addons_index_cache = {
+        key: value["addon"] for key, value in addons.items() if value["addon"]
+    }
+    return _addons_index_cache
+
+
+def _get_path_addon(path):
+    """Return the name of the indexed addon containing `path`, if any."""
+    path = Path(path).resolve()
+    try:
+        relative = path.relative_to(SRC_PATH)
+    except ValueError:
+        return None
+    index = _addons_index()
+    for parent in [relative] + list(relative.parents):
+        addon = index.get(parent.as_posix())
+        if addon:
+            return addon["name"]
+    return None
+
+
 def _get_cwd_addon(file):
     cwd = Path(file).resolve()
+    if SRC_PATH in cwd.parents:
+        addon = _get_path_addon(cwd)
+        if addon:
+            return addon
     manifest_file = False
     while PROJECT_ROOT < cwd:
         manifest_file = (cwd / "__manifest__.py").exists() or (
@@ -72,6 +431,151 @@ def _get_cwd_addon(file):
             return None
 
 
+ComposeContainer = namedtuple("ComposeContainer", ["id", "service", "state"])
+
+
+def _compose_state(c):
+    """Return the containers of the environment, keyed by service."""
+    with c.cd(str(PROJECT_ROOT)):
+        stdout = c.run(
+            "docker compose ps --all --format=json", hide=True, in_stream=False
+        ).stdout.strip()
+    # Older compose versions print a JSON array, newer ones one object per line
+    if stdout.startswith("["):
+        rows = json.loads(stdout)
+    else:
+        rows = [json.loads(line) for line in stdout.splitlines() if line.strip()]
+    return {
+        row["Service"]: ComposeContainer(row["ID"], row["Service"], row["State"])
+        for row in rows
+    }
+
+
+def _compose_changes(before, after):
+    """Return the services that were created, recreated or started in between."""
+    changed = set()
+    for service, container in after.items():
+        old = before.get(service)
+        if (
+            not old
+            or old.id != container.id
+            or (old.state != "running" and container.state == "running")
+        ):
+            changed.add(service)
+    return changed
+
+
+def _published_port(service, port):
+    """Return the host port where `port` of `service` is published, if any."""
+    config = yaml.safe_load((PROJECT_ROOT / "devel.yaml").read_text())
+    for mapping in config["services"].get(service, {}).get("ports", []):
+        published, _, target = str(mapping).rpartition(":")
+        if target == str(port):
+            return int(published.rpartition(":")[2])
+    return None
+
+
+def _probe_tcp(port):
+    with socket.create_connection(("localhost", port), timeout=1):
+        return True
+
+
+def _probe_http(url):
+    try:
+        with urllib.request.urlopen(url, timeout=2):
+            return True
+    except urllib.error.HTTPError as error:
+        # The proxy answers 5xx while Odoo is not up, anything else is Odoo
+        return error.code < 500
+
+
+def _wait_until(probe, deadline):
+    """Call `probe` with exponential backoff until it succeeds.
+
+    Returns how long it took, or `None` if `deadline` was reached first.
+    """
+    start, delay = time.time(), 0.05
+    while True:
+        try:
+            if probe():
+                return time.time() - start
+        except OSError:
+            pass
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 2)
+
+
+def _wait_for_services(c, http=True):
+    """Wait until the environment services are ready, probing concurrently.
+
+    Probes Postgres and, if `http` is set, Odoo behind the proxy (and its
+    longpolling port when running with workers). Gives up after
+    `SERVICES_READY_TIMEOUT` seconds.
+    """
+    probes = {}
+    db_port = _published_port("db", 5432)
+    if db_port:
+        psql_cmd = "docker compose exec -T db psql -U {} -tAc 'SELECT 1' postgres"
+
+        def probe_db():
+            return (
+                _probe_tcp(db_port)
+                and c.run(
+                    psql_cmd.format(DB_USER), warn=True, hide=True, in_stream=False
+                ).ok
+            )
+
+        probes["db"] = probe_db
+    web_port = _published_port("ha_proxy", 8069)
+    if http and web_port:
+        health = "/web/health" if ODOO_VERSION >= 15 else "/web/login"
+        probes["odoo"] = lambda: _probe_http(
+            "http://localhost:{}{}".format(web_port, health)
+        )
+        odoo_command = yaml.safe_load((PROJECT_ROOT / "devel.yaml").read_text())[
+            "services"
+        ]["odoo"].get("command", [])
+        longpolling_port = _published_port("ha_proxy", 8072)
+        # Odoo only listens on the longpolling port when running with workers
+        if longpolling_port and not any(
+            flag in ("--workers=0", "--workers") for flag in odoo_command
+        ):
+            path = "/websocket" if ODOO_VERSION >= 16 else "/longpolling/poll"
+            probes["longpolling"] = lambda: _probe_http(
+                "http://localhost:{}{}".format(longpolling_port, path)
+            )
+    if not probes:
+        return
+    if (
+        "SERVICES_WAIT_TIME" in os.environ
+        and "SERVICES_READY_TIMEOUT" not in os.environ
+    ):
+        _logger.warning(
+            "SERVICES_WAIT_TIME is deprecated, set SERVICES_READY_TIMEOUT instead"
+        )
+    deadline = time.time() + SERVICES_READY_TIMEOUT
+    with _timed("phase", "wait for services"), c.cd(str(PROJECT_ROOT)):
+        with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+            futures = {
+                name: executor.submit(_wait_until, probe, deadline)
+                for name, probe in probes.items()
+            }
+            elapsed = {name: future.result() for name, future in futures.items()}
+    for name, seconds in elapsed.items():
+        if seconds is None:
+            _logger.warning("%s not ready after %ss", name, int(SERVICES_READY_TIMEOUT))
+    ready = ", ".join(
+        "{} {:.1f}s".format(name, seconds)
+        for name, seconds in elapsed.items()
+        if seconds is not None
+    )
+    if ready:
+        _logger.info("Services ready: %s", ready)
+
+
 @task
 def develop(c):
     """Set up a basic development environment."""
@@ -83,11 +587,440 @@ def develop(c):
         c.run("pre-commit install")
 
 
-@task(develop)
-def git_aggregate(c, local=False, pre_commit_install=True):
+@contextmanager
+def _aggregate_env(local=True):
+    """Yield the environment needed to run git-aggregator on the host.
+
+    Without `local`, only the variables used to expand `repos.yaml` are set.
+    """
+    env = {
+        # Some defaults that are normally provided through setup-devel.yaml,
+        # which we are now by-passing
+        "DEPTH_DEFAULT": os.environ.get("DEPTH_DEFAULT", "100"),
+        "DEPTH_MERGE": os.environ.get("DEPTH_DEFAULT", "200"),
+        "ODOO_VERSION": f"{ODOO_VERSION}",
+    }
+    if not local:
+        yield env
+        return
+    # If we have been asked to run gitaggregate locally, we need to massage the ssh
+    # config file a bit by replacing the ~/.ssh path with the path to where it is in
+    # the project, in order to maintain compatibility.
+    #
+    # We do this through a temporary file, which is automatically cleaned up
+    # afterwards.
+    #
+    # If we want to remove gitaggregate from running inside the container, then we
+    # can look at removing this workaround entirely. If this was the case, what do
+    # we want to do with the keys? Drop per-project keys entirely?
+    # Allow the developer to use their own keys? What about external contributors?
+    with tempfile.NamedTemporaryFile(
+        mode="w",
+    ) as tmp_ssh_config:
+        ssh_path = PROJECT_ROOT / "odoo" / "custom" / "ssh"
+
+        with open(ssh_path / "config") as fd:
+            config = fd.read().replace(
+                "IdentityFile ~/.ssh", f"IdentityFile {str(ssh_path)}"
+            )
+            tmp_ssh_config.write(config)
+            tmp_ssh_config.flush()
+
+        # Tell git to use our custom ssh config file, which we've massaged
+        yield dict(env, GIT_SSH_COMMAND=f"ssh -F {tmp_ssh_config.name}")
+
+
+def _expand_env(value, env):
+    """Expand `$VAR` and `${VAR}` in `value` like `gitaggregate -e` does."""
+    if isinstance(value, dict):
+        return {k: _expand_env(v, env) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_expand_env(v, env) for v in value]
+    if not isinstance(value, str):
+        return value
+    return re.sub(
+        r"\$(\w+)|\$\((\w+)\)|\$\{(\w+)\}",
+        lambda m: env.get(next(filter(None, m.groups())), m.group(0)),
+        value,
+    )
+
+
+def _aggregate_command(config_file, repo, local):
+    """Return the command aggregating only `repo`, as configured in `config_file`."""
+    if local:
+        return f"gitaggregate -e -c {config_file} -d {repo}"
+    # Like doodba's autoaggregate, which runs as root: honour UMASK, and hand the
+    # code over to UID and GID, which git must thus accept to work with
+    path = os.path.normpath(f"/opt/odoo/custom/src/{repo}")
+    script = (
+        "[ -e ~/.ssh ] || ln -s /opt/odoo/custom/ssh ~/.ssh;"
+        ' umask "$UMASK" && git config --global --add safe.directory "*"'
+        f" && gitaggregate -e -c /opt/odoo/custom/src/{config_file} -d {path}"
+        f' && chown -R "$UID:$GID" {path}'
+    )
+    entrypoint = f"sh -c {shlex.quote(script)}"
+    return (
+        "docker compose --compatibility --file setup-devel.yaml run --rm --no-deps -T"
+        f" --entrypoint={shlex.quote(entrypoint)} odoo"
+    )
+
+
+def _repos_config(extra_env):
+    """Return `repos.yaml` with its variables expanded, keyed by directory."""
+    with open(SRC_PATH / "repos.yaml") as fd:
+        repos = yaml.safe_load(fd.read()) or {}
+    return _expand_env(repos, dict(os.environ, **extra_env))
+
+
+def _repo_merges(config):
+    """Return the `(remote, ref)` pairs merged in a repository."""
+    result = []
+    for merge in config.get("merges", []):
+        if isinstance(merge, dict):
+            result.append((merge["remote"], str(merge["ref"])))
+        else:
+            remote, ref = str(merge).split(None, 1)
+            result.append((remote, ref))
+    return result
+
+
+def _is_sha(ref):
+    return bool(re.match(r"^[0-9a-f]{40}$", ref))
+
+
+def _ls_remote(url, ref, extra_env):
+    """Return the commit that `ref` points to in the remote `url`, or `None`."""
+    try:
+        output = subprocess.run(
+            ["git", "ls-remote", url, ref],
+            env=dict(os.environ, GIT_TERMINAL_PROMPT="0", **extra_env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+            check=True,
+        ).stdout.decode()
+    except (subprocess.SubprocessError, OSError):
+        return None
+    return _pick_remote_ref(output, ref)
+
+
+def _container_ls_remote(c, queries):
+    """Resolve `(url, ref)` queries with `git ls-remote` in a single container.
+
+    The container is the one `git-aggregate` runs, so the host needs no access
+    to the remotes. Returns a dict mapping each query to its commit or `None`.
+    """
+    # Like doodba's autoaggregate, use the project keys baked in the image
+    script = ["[ -e ~/.ssh ] || ln -s /opt/odoo/custom/ssh ~/.ssh"]
+    for i, (url, ref) in enumerate(queries):
+        script.append("echo '#{}'".format(i))
+        script.append(
+            "GIT_TERMINAL_PROMPT=0 timeout 60 git ls-remote -- {} {} 2>/dev/null".format(
+                shlex.quote(url), shlex.quote(ref)
+            )
+        )
+    with c.cd(str(PROJECT_ROOT)):
+        result = c.run(
+            "docker compose --compatibility --file setup-devel.yaml run --rm -T"
+            " --entrypoint sh odoo -c {}".format(shlex.quote("; ".join(script))),
+            env=_override_docker_env(),
+            hide=True,
+            warn=True,
+            in_stream=False,
+        )
+    outputs, current = {}, None
+    for line in result.stdout.splitlines():
+        if re.match(r"^#\d+$", line):
+            current = int(line[1:])
+            outputs[current] = []
+        elif current is not None:
+            outputs[current].append(line)
+    if not outputs:
+        _logger.warning("Could not resolve the remote branches in a container")
+    return {
+        query: _pick_remote_ref("\n".join(outputs.get(i, [])), query[1])
+        for i, query in enumerate(queries)
+    }
+
+
+def _pick_remote_ref(output, ref):
+    """Return the commit of `ref` in the output of `git ls-remote`, or `None`."""
+    refs = dict(
+        reversed(line.split("\t", 1)) for line in output.splitlines() if "\t" in line
+    )
+    # Prefer branches, then peeled tags
+    for candidate in (
+        f"refs/heads/{ref}",
+        "refs/tags/%s^{}" % ref,
+        f"refs/tags/{ref}",
+        ref,
+    ):
+        if candidate in refs:
+            return refs[candidate]
+    return next(iter(refs.values()), None)
+
+
+def _local_head(repo):
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "-C", str(SRC_PATH / repo), "rev-parse", "HEAD"],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def _repo_config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def _resolve_remote_refs(c, repos, extra_env, local):
+    """Map the `(url, ref)` of every merge in `repos` to its remote commit.
+
+    Refs are resolved on the host with `local`, or in a container otherwise.
+    """
+    queries = sorted(
+        {
+            (config.get("remotes", {}).get(remote, remote), ref)
+            for config in repos.values()
+            for remote, ref in _repo_merges(config)
+            if not _is_sha(ref)
+        }
+    )
+    if not queries:
+        return {}
+    if not local:
+        return _container_ls_remote(c, queries)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return dict(
+            zip(
+                queries,
+                executor.map(lambda query: _ls_remote(*query, extra_env), queries),
+            )
+        )
+
+
+def _repos_lock_entry(config, resolved):
+    """Return the lock entry of a repository from the `resolved` remote refs."""
+    remotes = config.get("remotes", {})
+    return {
+        "config": _repo_config_hash(config),
+        "merges": [
+            [
+                remote,
+                ref,
+                ref
+                if _is_sha(ref)
+                else resolved.get((remotes.get(remote, remote), ref)),
+            ]
+            for remote, ref in _repo_merges(config)
+        ],
+    }
+
+
+def _read_json(path):
+    try:
+        with open(str(path)) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), "w") as fd:
+        json.dump(data, fd, indent=2, sort_keys=True)
+        fd.write("\n")
+
+
+def _frozen_repos_config(repos, lock):
+    """Return `repos` with every merge pinned to the commit in `lock`."""
+    frozen = {}
+    for repo, config in repos.items():
+        config = dict(config)
+        config["merges"] = [
+            f"{remote} {sha or ref}" for remote, ref, sha in lock[repo]["merges"]
+        ]
+        frozen[repo] = config
+    return frozen
+
+
+def _git_mirror_path(url):
+    """Return the path of the shared bare mirror of the remote `url`."""
+    name = re.sub(r"^[\w+]+://|^[\w.-]+@", "", url.rstrip("/"))
+    name = re.sub(r"\.git$", "", name)
+    return GIT_MIRRORS_PATH / "{}.git".format(re.sub(r"[^\w.-]+", "_", name))
+
+
+@contextmanager
+def _git_mirror_lock(mirror):
+    """Hold an exclusive lock on `mirror`, shared with other projects."""
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+    with open("{}.lock".format(mirror), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _update_git_mirror(url, refs, extra_env):
+    """Fetch `refs` from `url` into its shared mirror, returning the mirror.
+
+    Mirrors get the full history: a repository borrowing objects from a
+    shallow one would miss the parents that merges and logs need.
+    """
+    mirror = _git_mirror_path(url)
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0", **extra_env)
+    with _git_mirror_lock(mirror):
+        if not (mirror / "HEAD").exists():
+            subprocess.run(
+                ["git", "init", "--quiet", "--bare", str(mirror)], check=True
+            )
+            # Projects borrow its objects, so they must never be pruned
+            subprocess.run(
+                ["git", "-C", str(mirror), "config", "gc.auto", "0"], check=True
+            )
+        cmd = ["git", "-C", str(mirror), "fetch", "--quiet", "--no-tags"]
+        if (mirror / "shallow").exists():
+            cmd.append("--unshallow")
+        cmd.append(url)
+        cmd.extend("+{0}:refs/mirror/{0}".format(ref) for ref in sorted(set(refs)))
+        try:
+            subprocess.run(cmd, env=env, check=True)
+        except subprocess.CalledProcessError:
+            _logger.warning("Could not update the git mirror of %s", url)
+    return mirror
+
+
+def _link_git_mirrors(repo, config, mirrors, extra_env):
+    """Make repository `repo` borrow objects from the shared `mirrors`.
+
+    New repositories are initialized with the first merge, fetching only
+    the objects missing in the mirrors, so gitaggregate just updates them.
+    """
+    repo_path = SRC_PATH / repo
+    alternates = repo_path / ".git" / "objects" / "info" / "alternates"
+    is_new = not (repo_path / ".git").exists()
+    if is_new:
+        subprocess.run(["git", "init", "--quiet", str(repo_path)], check=True)
+    existing = alternates.read_text().splitlines() if alternates.exists() else []
+    # Mirrors still shallow because their last update failed are not safe to use
+    new = [
+        str(m / "objects")
+        for m in mirrors
+        if str(m / "objects") not in existing and not (m / "shallow").exists()
+    ]
+    if new:
+        alternates.write_text("".join(line + "\n" for line in existing + new))
+    if not is_new:
+        return
+    remote, ref = _repo_merges(config)[0]
+    target = config.get("target") or "_git_aggregated"
+    branch = target["branch"] if isinstance(target, dict) else str(target).split()[-1]
+    url = config.get("remotes", {}).get(remote, remote)
+    git = ["git", "-C", str(repo_path)]
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0", **extra_env)
+    try:
+        subprocess.run(git + ["remote", "add", remote, url], check=True)
+        subprocess.run(
+            git
+            + ["fetch", "--quiet", "--depth={}".format(extra_env["DEPTH_DEFAULT"])]
+            + [remote, ref],
+            env=env,
+            check=True,
+        )
+        subprocess.run(
+            git + ["checkout", "--quiet", "-B", branch, "FETCH_HEAD"],
+            check=True,
+        )
+    except subprocess.CalledProcessError:
+        # Let gitaggregate clone it from scratch
+        _logger.warning("Could not initialize %s from the git mirrors", repo)
+        shutil.rmtree(str(repo_path))
+
+
+def _register_git_mirrors(mirrors):
+    """Record the mirrors used by this project, for `git-mirrors-gc`."""
+    projects = GIT_MIRRORS_PATH / "projects"
+    projects.mkdir(parents=True, exist_ok=True)
+    key = hashlib.sha1(str(PROJECT_ROOT).encode()).hexdigest()
+    registration = projects / "{}.json".format(key)
+    try:
+        known = set(json.loads(registration.read_text())["mirrors"])
+    except (IOError, ValueError, KeyError):
+        known = set()
+    # Keep mirrors of repositories still aggregated, but not updated this time
+    known = {
+        name
+        for name in known
+        if any(
+            str(GIT_MIRRORS_PATH / name / "objects") in path.read_text()
+            for path in SRC_PATH.glob("*/.git/objects/info/alternates")
+        )
+    }
+    known.update(mirror.name for mirror in mirrors)
+    registration.write_text(
+        json.dumps({"project": str(PROJECT_ROOT), "mirrors": sorted(known)}, indent=2)
+    )
+
+
+def _use_git_mirrors(repos, pending, extra_env):
+    """Prefill `pending` repositories from the shared git mirrors."""
+    refs = {}
+    for repo in pending:
+        remotes = repos[repo].get("remotes", {})
+        for remote, ref in _repo_merges(repos[repo]):
+            refs.setdefault(remotes.get(remote, remote), []).append(ref)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        mirrors = dict(
+            zip(
+                refs,
+                executor.map(
+                    lambda url: _update_git_mirror(url, refs[url], extra_env),
+                    refs,
+                ),
+            )
+        )
+    for repo in pending:
+        remotes = repos[repo].get("remotes", {})
+        _link_git_mirrors(
+            repo,
+            repos[repo],
+            [mirrors[url] for url in dict.fromkeys(remotes.values()) if url in mirrors],
+            extra_env,
+        )
+    _register_git_mirrors(mirrors.values())
+
+
+@task(
+    develop,
+    help={
+        "local": "Run git-aggregator on the host instead of in a container",
+        "frozen": "Aggregate exactly the commits recorded in repos.lock",
+        "force": "Aggregate all repositories, even if they seem up to date",
+        "shared_store": "Share git objects with other projects through mirrors in"
+        " $GIT_MIRRORS_PATH. Requires --local",
+    },
+)
+def git_aggregate(
+    c,
+    local=False,
+    pre_commit_install=True,
+    frozen=False,
+    force=False,
+    shared_store=False,
+):
     """Download odoo & addons git code.
 
     Executes git-aggregator from within the doodba container, or locally if specified.
+
+    Only repositories whose configuration or remote branches changed since the last
+    aggregation, as recorded in `repos.lock`, are aggregated again.
     """
 
     if local:
@@ -100,58 +1033,93 @@ def git_aggregate(c, local=False, pre_commit_install=True):
         _logger.warn("Running git-aggregate locally is currently experimental!")
 
         # XXX: Why run locally? So that we can start using git-autoshare!
-        #
-        # If we have been asked to run gitaggregate locally, we need to massage the ssh
-        # config file a bit by replacing the ~/.ssh path with the path to where it is in
-        # the project, in order to maintain compatibility.
-        #
-        # We do this through a temporary file, which is automatically cleaned up
-        # afterwards.
-        #
-        # If we want to remove gitaggregate from running inside the container, then we
-        # can look at removing this workaround entirely. If this was the case, what do
-        # we want to do with the keys? Drop per-project keys entirely?
-        # Allow the developer to use their own keys? What about external contributors?
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-        ) as tmp_ssh_config:
-            ssh_path = PROJECT_ROOT / "odoo" / "custom" / "ssh"
-
-            with open(ssh_path / "config") as fd:
-                config = fd.read().replace(
-                    "IdentityFile ~/.ssh", f"IdentityFile {str(ssh_path)}"
+    elif shared_store:
+        raise exceptions.ParseError(msg="--shared-store can only be used with --local")
+
+    with _aggregate_env(local) as extra_env:
+        repos = _repos_config(extra_env)
+        lock = _read_json(REPOS_LOCK_FILE)
+        state = _read_json(REPOS_STATE_FILE)
+        if frozen:
+            missing = set(repos) - set(lock)
+            if missing:
+                raise exceptions.ParseError(
+                    msg=f"{', '.join(sorted(missing))} not found in repos.lock"
                 )
-                tmp_ssh_config.write(config)
-                tmp_ssh_config.flush()
-
-            extra_env = {
-                # Tell git to use our custom ssh config file, which we've massaged
-                "GIT_SSH_COMMAND": f"ssh -F {tmp_ssh_config.name}",
-                # Some defaults that are normally provided through setup-devel.yaml,
-                # which we are now by-passing
-                "DEPTH_DEFAULT": os.environ.get("DEPTH_DEFAULT", "100"),
-                "DEPTH_MERGE": os.environ.get("DEPTH_DEFAULT", "200"),
-                "ODOO_VERSION": f"{ODOO_VERSION}",
+            new_lock = {
+                repo: {
+                    "config": _repo_config_hash(config),
+                    "merges": lock[repo]["merges"],
+                }
+                for repo, config in repos.items()
             }
+        else:
+            with _timed("phase", "resolve remotes"):
+                resolved = _resolve_remote_refs(c, repos, extra_env, local)
+            new_lock = {
+                repo: _repos_lock_entry(config, resolved)
+                for repo, config in repos.items()
+            }
+        pending = [
+            repo
+            for repo, entry in new_lock.items()
+            if force
+            or repo not in state
+            or entry["config"] != state[repo]["config"]
+            or entry["merges"] != state[repo]["merges"]
+            or any(sha is None for _, _, sha in entry["merges"])
+            or _local_head(repo) is None
+            or _local_head(repo) != state[repo].get("head")
+        ]
 
+        if not pending:
+            _logger.info("All repositories are up to date, nothing to aggregate")
+        else:
+            config_file = "repos.yaml"
+            if frozen:
+                # Written in the mounted sources, so the container sees it too
+                config_file = ".repos.frozen.yaml"
+                with open(SRC_PATH / config_file, "w") as fd:
+                    fd.write(yaml.dump(_frozen_repos_config(repos, lock)))
+            if shared_store:
+                with _timed("phase", "update git mirrors"):
+                    _use_git_mirrors(
+                        _frozen_repos_config(repos, lock) if frozen else repos,
+                        pending,
+                        extra_env,
+                    )
             concurrent_jobs = len(os.sched_getaffinity(0))
-
-            with c.cd(SRC_PATH):
-                c.run(
-                    f"gitaggregate -e -c repos.yaml -j {concurrent_jobs}",
-                    env=extra_env,
-                    pty=True,
-                )
-    else:
-        with c.cd(str(PROJECT_ROOT)):
-            c.run(
-                "docker compose --compatibility --file setup-devel.yaml run --rm odoo",
-                env=_override_docker_env(),
-                pty=True,
-            )
+            try:
+                with _timed("phase", "aggregate"), c.cd(
+                    str(SRC_PATH if local else PROJECT_ROOT)
+                ), ThreadPoolExecutor(concurrent_jobs) as executor:
+                    # Each call only aggregates the repository matching its directory
+                    list(
+                        executor.map(
+                            lambda repo: c.run(
+                                _aggregate_command(config_file, repo, local),
+                                env=extra_env if local else _override_docker_env(),
+                                in_stream=False,
+                            ),
+                            pending,
+                        )
+                    )
+            finally:
+                if frozen:
+                    (SRC_PATH / config_file).unlink()
+
+    if new_lock != lock:
+        _write_json(REPOS_LOCK_FILE, new_lock)
+    _write_json(
+        REPOS_STATE_FILE,
+        {repo: dict(entry, head=_local_head(repo)) for repo, entry in new_lock.items()},
+    )
 
     if pre_commit_install:
+        aggregated = {(SRC_PATH / repo).resolve() for repo in pending}
         for git_folder in SRC_PATH.glob("*/.git/.."):
+            if git_folder.resolve() not in aggregated:
+                continue
             action = (
                 "install"
                 if (git_folder / ".pre-commit-config.yaml").is_file()
@@ -161,6 +1129,44 @@ def git_aggregate(c, local=False, pre_commit_install=True):
                 c.run(f"pre-commit {action}")
 
 
+@task(
+    help={
+        "dry_run": "Only print the mirrors that would be removed",
+    },
+)
+def git_mirrors_gc(c, dry_run=False):
+    """Remove shared git mirrors no longer used by any project.
+
+    Projects register the mirrors they use in `git-aggregate --shared-store`.
+    Registrations of projects that no longer exist are dropped.
+    """
+    projects = GIT_MIRRORS_PATH / "projects"
+    used = set()
+    for registration in sorted(projects.glob("*.json")):
+        try:
+            data = json.loads(registration.read_text())
+        except ValueError:
+            data = {}
+        if not Path(data.get("project", "")).joinpath("odoo", "custom").is_dir():
+            _logger.info(
+                "Forgetting removed project %s", data.get("project", registration)
+            )
+            if not dry_run:
+                registration.unlink()
+            continue
+        used.update(data.get("mirrors", []))
+    for mirror in sorted(GIT_MIRRORS_PATH.glob("*.git")):
+        with _git_mirror_lock(mirror):
+            if mirror.name in used:
+                # Pack objects, but keep unreachable ones that projects may borrow
+                if not dry_run:
+                    c.run(f"git -C {mirror} repack -a -d -q --keep-unreachable")
+                continue
+            _logger.info("Removing unused mirror %s", mirror)
+            if not dry_run:
+                shutil.rmtree(str(mirror))
+
+
 @task(develop)
 def closed_prs(c):
     with c.cd(str(PROJECT_ROOT)):
@@ -172,14 +1178,149 @@ def closed_prs(c):
         c.run(cmd, env=_override_docker_env(), pty=True)
 
 
-@task(develop)
-def img_build(c, pull=True):
-    """Build docker images."""
-    cmd = "docker compose --compatibility build"
-    if pull:
-        cmd += " --pull"
-    with c.cd(str(PROJECT_ROOT)):
-        c.run(cmd, env=_override_docker_env(), pty=True)
+def _odoo_build_config():
+    return yaml.safe_load((PROJECT_ROOT / "devel.yaml").read_text())["services"][
+        "odoo"
+    ]["build"]
+
+
+def _base_images():
+    """Return the images the odoo Dockerfile builds from, with its args expanded."""
+    args = {
+        name: str(value)
+        for name, value in (_odoo_build_config().get("args") or {}).items()
+    }
+    try:
+        dockerfile = (PROJECT_ROOT / "odoo" / "Dockerfile").read_text()
+    except IOError:
+        return []
+    images, stages = [], set()
+    for line in dockerfile.splitlines():
+        words = line.split()
+        if len(words) < 2:
+            continue
+        instruction = words[0].upper()
+        if instruction == "ARG":
+            name, _, default = words[1].partition("=")
+            args.setdefault(name, default)
+        elif instruction == "FROM":
+            words = [word for word in words[1:] if not word.startswith("--")]
+            if len(words) == 3 and words[1].upper() == "AS":
+                stages.add(words[2])
+            image = _expand_env(words[0], args)
+            if image not in stages:
+                images.append(image)
+    return images
+
+
+def _image_id(c, image):
+    """Return the ID of a local docker image, or `None` if it isn't there."""
+    result = c.run(f"docker image inspect {shlex.quote(image)}", hide=True, warn=True)
+    return json.loads(result.stdout)[0]["Id"] if result.ok else None
+
+
+def _build_inputs_hash(base_image_ids=()):
+    """Hash the inputs of the odoo image that aren't bind-mounted in development.
+
+    These are the base images, the build arguments, the Dockerfile, `build.d`
+    and the dependencies files. Addons code is mounted, so it doesn't need a
+    rebuild.
+    """
+    digest = hashlib.sha1()
+    digest.update(
+        json.dumps(
+            [list(base_image_ids), _odoo_build_config(), UID_ENV], sort_keys=True
+        ).encode()
+    )
+    odoo_path = PROJECT_ROOT / "odoo"
+    paths = [odoo_path / "Dockerfile"]
+    for directory in ("build.d", "dependencies"):
+        paths.extend(sorted((odoo_path / "custom" / directory).rglob("*")))
+    for path in paths:
+        if path.is_file():
+            digest.update(str(path.relative_to(odoo_path)).encode() + b"\0")
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+@task(
+    develop,
+    help={
+        "pull": "Pull a newer version of the base image first. Default: True",
+        "force": "Build even if an image with the same base image and build inputs"
+        " exists",
+        "cache": "Use a persistent local BuildKit cache. Default: True",
+        "cache-dir": "Directory of the BuildKit cache. It can be copied to other"
+        " machines, i.e. to CI. Defaults to $BUILD_CACHE_PATH or"
+        " ~/.cache/odoo-scaffolding/buildkit/<project>",
+    },
+)
+def img_build(c, pull=True, force=False, cache=True, cache_dir=None):
+    """Build docker images.
+
+    The build is skipped when the image was already built from the same base
+    image, Dockerfile, build arguments, `build.d` and dependencies files.
+    """
+    base_image_ids = []
+    with _timed("phase", "base images"):
+        for image in _base_images():
+            if pull:
+                c.run(f"docker pull {shlex.quote(image)}", warn=True, in_stream=False)
+            base_image_ids.append(_image_id(c, image))
+    build_hash = _build_inputs_hash(base_image_ids)
+    labels = {IMAGE_HASH_LABEL: build_hash, IMAGE_PROJECT_LABEL: str(PROJECT_ROOT)}
+    if not force:
+        filters = " ".join(
+            "--filter label={}".format(shlex.quote("{}={}".format(*label)))
+            for label in labels.items()
+        )
+        images = c.run(
+            f"docker image ls -q {filters}", hide=True, warn=True
+        ).stdout.split()
+        if images:
+            _logger.info(
+                "Image already built from the same inputs (%s), skipping build."
+                " Use --force to build anyway",
+                build_hash[:12],
+            )
+            return
+    build = {"labels": labels}
+    env = _override_docker_env()
+    if cache:
+        cache_dir = Path(cache_dir or BUILD_CACHE_PATH)
+        new_cache_dir = cache_dir.with_name(cache_dir.name + ".new")
+        if (cache_dir / "index.json").exists():
+            build["cache_from"] = [f"type=local,src={cache_dir}"]
+        # Local caches only grow, so export to a new one and swap them
+        build["cache_to"] = [f"type=local,dest={new_cache_dir},mode=max"]
+        if c.run(
+            f"docker buildx inspect {BUILDX_BUILDER}", hide=True, warn=True
+        ).failed:
+            c.run(
+                f"docker buildx create --name {BUILDX_BUILDER}"
+                " --driver docker-container",
+                hide=True,
+            )
+        env["BUILDX_BUILDER"] = BUILDX_BUILDER
+    with tempfile.NamedTemporaryFile(
+        mode="w",
+        suffix=".yaml",
+    ) as tmp_docker_compose_file:
+        tmp_docker_compose_file.write(
+            yaml.dump({"services": {"odoo": {"build": build}}})
+        )
+        tmp_docker_compose_file.flush()
+        cmd = (
+            "docker compose --compatibility -f docker-compose.yml "
+            f"-f {tmp_docker_compose_file.name} build"
+        )
+        if pull:
+            cmd += " --pull"
+        with c.cd(str(PROJECT_ROOT)):
+            c.run(cmd, env=env, pty=True)
+    if cache and new_cache_dir.exists():
+        shutil.rmtree(str(cache_dir), ignore_errors=True)
+        new_cache_dir.rename(cache_dir)
 
 
 @task(develop)
@@ -212,8 +1353,9 @@ def start(c, detach=True, debugpy=False):
             )
         if detach:
             cmd += " --detach"
+        before = _compose_state(c) if detach else {}
         with c.cd(str(PROJECT_ROOT)):
-            result = c.run(
+            c.run(
                 cmd,
                 pty=True,
                 env=dict(
@@ -221,14 +1363,21 @@ def start(c, detach=True, debugpy=False):
                     DOODBA_DEBUGPY_ENABLE=str(int(debugpy)),
                 ),
             )
-            if not (
-                "Recreating" in result.stdout
-                or "Starting" in result.stdout
-                or "Creating" in result.stdout
-            ):
-                restart(c)
-        _logger.info("Waiting for services to spin up...")
-        time.sleep(SERVICES_WAIT_TIME)
+        if detach:
+            after = _compose_state(c)
+            changed = _compose_changes(before, after)
+            # Proxies must be restarted to reach a changed service reliably
+            stale = sorted(
+                proxy
+                for service in changed
+                for proxy in PROXY_SERVICES.get(service, ())
+                if proxy in after and proxy not in changed
+            )
+            if stale:
+                restart(c, services=",".join(stale))
+            _logger.info("Waiting for services to spin up...")
+            # Odoo waits for the debugger to attach before serving anything
+            _wait_for_services(c, http=not debugpy)
 
 
 @task(
@@ -287,85 +1436,771 @@ def install(
         )
 
 
-def _test_in_debug_mode(c, odoo_command, database):
-    with tempfile.NamedTemporaryFile(
-        mode="w", suffix=".yaml"
-    ) as tmp_docker_compose_file:
-        cmd = (
-            "docker compose --compatibility -f docker-compose.yml "
-            f"-f {tmp_docker_compose_file.name} up -d"
+def _test_in_debug_mode(c, odoo_command, database):
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".yaml"
+    ) as tmp_docker_compose_file:
+        cmd = (
+            "docker compose --compatibility -f docker-compose.yml "
+            f"-f {tmp_docker_compose_file.name} up -d"
+        )
+        _override_docker_command(
+            "odoo",
+            odoo_command,
+            file=tmp_docker_compose_file,
+        )
+        with c.cd(str(PROJECT_ROOT)):
+            c.run(
+                cmd,
+                env=dict(
+                    _override_docker_env(database),
+                    DOODBA_DEBUGPY_ENABLE="1",
+                ),
+                pty=True,
+            )
+        _logger.info("Waiting for services to spin up...")
+        _wait_for_services(c, http=False)
+
+
+def _is_aggregated():
+    """Check if all repositories from `repos.yaml` exist locally."""
+    try:
+        with open(SRC_PATH / "repos.yaml") as fd:
+            repos = yaml.safe_load(fd.read()) or {}
+    except IOError:
+        return False
+    return bool(repos) and all((SRC_PATH / repo).is_dir() for repo in repos)
+
+
+def _addons_config():
+    """Yield `(addon, repo)` pairs enabled in `addons.yaml`.
+
+    Host-side port of doodba's `addons_config()`. Returns `None` when the
+    configuration can only be understood inside the container (i.e. `ONLY`
+    sections, which depend on the container environment) or is ambiguous.
+    """
+    all_globs = {}
+    try:
+        with open(SRC_PATH / "addons.yaml") as fd:
+            docs = list(yaml.safe_load_all(fd.read()))
+    except IOError:
+        docs = []
+    for doc in docs:
+        if not doc:
+            continue
+        if "ONLY" in doc:
+            _logger.debug("addons.yaml uses ONLY sections, cannot resolve locally")
+            return None
+        for repo, partial_globs in doc.items():
+            if repo == "ENV":
+                continue
+            all_globs.setdefault(repo, set()).update(partial_globs)
+    # Add default values for special sections
+    for repo in (CORE, PRIVATE):
+        all_globs.setdefault(repo, {"*"})
+    index = _addons_index()
+    config = {}
+    for repo, partial_globs in all_globs.items():
+        repo = os.path.normpath(repo)
+        for partial_glob in partial_globs:
+            found = False
+            for addon in index.values():
+                if addon["repo"] == repo and fnmatch(addon["name"], partial_glob):
+                    config.setdefault(addon["name"], set()).add(repo)
+                    found = True
+            # Projects without private addons should never warn
+            if not found and (repo, partial_glob) != (PRIVATE, "*"):
+                _logger.warning(
+                    "Glob %s in addons.yaml matches no addon in %s", partial_glob, repo
+                )
+    result = []
+    for addon, repos in config.items():
+        # Private addons are most important
+        if PRIVATE in repos:
+            result.append((addon, PRIVATE))
+            continue
+        # Odoo core addons are least important
+        if repos == {CORE}:
+            result.append((addon, CORE))
+            continue
+        repos.discard(CORE)
+        if len(repos) != 1:
+            _logger.debug("Addon %s defined in several repos %s", addon, repos)
+            return None
+        result.append((addon, repos.pop()))
+    return result
+
+
+def _resolve_addons(
+    modules=None,
+    core=False,
+    extra=False,
+    private=False,
+    enterprise=False,
+    only_installable=True,
+):
+    """Host-side equivalent of `addons list`.
+
+    Returns a sorted list of addon names, or `None` if it cannot be resolved
+    without the container.
+    """
+    config = _addons_config()
+    if config is None:
+        return None
+    with_ = set(modules.split(",")) if modules else set()
+    addons = set()
+    for addon, repo in config:
+        core_ok = core and repo == CORE
+        enterprise_ok = enterprise and repo == ENTERPRISE
+        extra_ok = extra and repo not in {CORE, ENTERPRISE, PRIVATE}
+        private_ok = private and repo == PRIVATE
+        manual_ok = addon in with_
+        if not (private_ok or core_ok or extra_ok or enterprise_ok or manual_ok):
+            continue
+        manifest = _addons_index()["{}/{}".format(repo, addon)]
+        if only_installable and not manifest["installable"]:
+            continue
+        addons.add(addon)
+    return sorted(addons)
+
+
+def _reverse_dependencies(addons, depth=-1):
+    """Find the enabled addons that depend, directly or not, on `addons`.
+
+    Returns a dict mapping each dependant addon to a `(depth, via)` tuple,
+    where `via` is the addon it depends on that brought it in. A negative
+    `depth` follows the whole dependency graph.
+    """
+    enabled = _resolve_addons(private=True, extra=True, enterprise=True)
+    if enabled is None:
+        # Could not resolve addons.yaml locally, consider all private addons
+        enabled = [a["name"] for a in _addons_index().values() if a["repo"] == PRIVATE]
+    enabled = set(enabled)
+    dependants = {}
+    for addon in _addons_index().values():
+        if addon["name"] in enabled and addon["installable"]:
+            for dependency in addon["depends"]:
+                dependants.setdefault(dependency, set()).add(addon["name"])
+    result = {}
+    seen = set(addons)
+    current, level = sorted(seen), 0
+    while current and level != depth:
+        level += 1
+        following = []
+        for addon in current:
+            for dependant in sorted(dependants.get(addon, ())):
+                if dependant not in seen:
+                    seen.add(dependant)
+                    result[dependant] = (level, addon)
+                    following.append(dependant)
+        current = following
+    return result
+
+
+def _get_module_list(
+    c,
+    modules=None,
+    core=False,
+    extra=False,
+    private=False,
+    enterprise=False,
+    only_installable=True,
+):
+    """Returns a list of addons according to the passed parameters.
+
+    By default, refers to the addon from directory being worked on,
+    unless other options are specified.
+
+    Addons are resolved on the host when the source tree has been aggregated,
+    falling back to doodba's `addons list` inside a container otherwise.
+    """
+    if _is_aggregated():
+        module_list = _resolve_addons(
+            modules, core, extra, private, enterprise, only_installable
+        )
+        if module_list is not None:
+            return ",".join(module_list)
+        _logger.debug("Could not resolve addons locally, asking the container")
+    # Get list of dependencies for addon
+    cmd = "docker compose --compatibility run --rm odoo addons list"
+    if core:
+        cmd += " --core"
+    if extra:
+        cmd += " --extra"
+    if private:
+        cmd += " --private"
+    if enterprise:
+        cmd += " --enterprise"
+    if modules:
+        cmd += f" -w {modules}"
+    if only_installable:
+        cmd += " --installable"
+    with c.cd(str(PROJECT_ROOT)):
+        module_list = c.run(
+            cmd,
+            env=UID_ENV,
+            pty=True,
+            hide="stdout",
+        ).stdout.splitlines()[-1]
+    return module_list
+
+
+def _test_inject_coverage(odoo_command, modules_list, contexts=False):
+    """Wrap `odoo_command` in `coverage run`.
+
+    Every run writes its own data file (`--parallel-mode`), so concurrent
+    runs don't clash; `test-coverage-report` combines them. With `contexts`,
+    the test function covering each line is recorded as well.
+    """
+    # Inject coverage into the command
+    coverage_paths = ",".join(
+        map(lambda m: "/opt/odoo/custom/src/private/{}".format(m), modules_list)
+    )
+    if coverage_paths:
+        odoo_command[0] = "/usr/local/bin/odoo"
+        coverage_command = [
+            "coverage",
+            "run",
+            "--parallel-mode",
+            "--data-file=/opt/odoo/auto/.coverage",
+            "--source={}".format(coverage_paths),
+        ]
+        if contexts:
+            COVERAGE_CONTEXTS_RCFILE.parent.mkdir(parents=True, exist_ok=True)
+            COVERAGE_CONTEXTS_RCFILE.write_text(
+                "[run]\ndynamic_context = test_function\n"
+            )
+            coverage_command.append(
+                "--rcfile=/opt/odoo/auto/{}".format(COVERAGE_CONTEXTS_RCFILE.name)
+            )
+        else:
+            # Lowest overhead tracer, where the interpreter supports it
+            # (Python 3.12+). Coverage falls back to its default one otherwise.
+            coverage_command = ["env", "COVERAGE_CORE=sysmon"] + coverage_command
+        odoo_command = coverage_command + odoo_command
+
+    return odoo_command
+
+
+def _test_odoo_command(modules_list, mode, coverage=False, **coverage_kwargs):
+    odoo_command = ["odoo", "--test-enable", "--stop-after-init", "--workers=0"]
+    if mode == "init":
+        odoo_command.append("-i")
+    elif mode == "update":
+        odoo_command.append("-u")
+    else:
+        raise exceptions.ParseError(
+            msg="Available modes are 'init' or 'update'. See --help for details."
+        )
+    odoo_command.append(",".join(modules_list))
+
+    if coverage and modules_list:
+        odoo_command = _test_inject_coverage(
+            odoo_command, modules_list, **coverage_kwargs
+        )
+
+    if ODOO_VERSION >= 12:
+        # Limit tests to explicit list
+        # Filter spec format (comma-separated)
+        # [-][tag][/module][:class][.method]
+        odoo_command.extend(["--test-tags", "/" + ",/".join(modules_list)])
+    return odoo_command
+
+
+_ODOO_LOG_LINE = re.compile(
+    r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) (\d+) \w+ \S+ ([\w.]+): (.*)$"
+)
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+_TEST_START = re.compile(r"^Starting (\w+)\.(\w+) \.\.\.")
+# Both `FAIL: Class.method` and `FAIL: method (odoo.addons.x.tests.y.Class)`, the
+# latter ending with `.method` since Python 3.11, maybe followed by subtest details
+_TEST_FAILURE = re.compile(
+    r"^(FAIL|ERROR): (?:(\w+)\.(\w+)|(\w+) \(([\w.]+)\))(?: \[.*\]| \(.*\))*$"
+)
+# Messages after which the running test is over, whatever logs them: other tests
+# or Odoo starting something, and addons being loaded for the next tests
+_TEST_END_MESSAGE = re.compile(r"^(?:Starting |module \w+: loading|Loading module )")
+# Loggers that only log once the running test is over
+_TEST_END_LOGGERS = (
+    "odoo.modules.loading",
+    "odoo.modules.module",
+    "odoo.modules.registry",
+    "odoo.service.server",
+    "odoo.tests.result",
+    "odoo.tests.stats",
+)
+
+
+def _parse_test_log(lines):
+    """Return the tests run in an Odoo log, with their duration and status.
+
+    A test lasts from its `Starting Class.method ...` line until the next
+    test starts, or Odoo goes on with something else, in the same process.
+    What Odoo logs between tests, like installing the next module or starting
+    post-install tests, is thus not charged to the last test that ran.
+    """
+    tests, running, when = [], {}, None
+    for line in lines:
+        match = _ODOO_LOG_LINE.match(_ANSI_ESCAPE.sub("", line.rstrip()))
+        if not match:
+            continue
+        stamp, millis, pid, logger, message = match.groups()
+        when = time.mktime(time.strptime(stamp, "%Y-%m-%d %H:%M:%S")) + (
+            int(millis) / 1000
+        )
+        start = _TEST_START.match(message)
+        if pid in running and (
+            _TEST_END_MESSAGE.match(message) or logger.startswith(_TEST_END_LOGGERS)
+        ):
+            test = running.pop(pid)
+            test["duration"] = round(when - test.pop("start"), 3)
+        if start and logger.startswith("odoo.addons."):
+            running[pid] = {
+                "module": logger.split(".")[2],
+                "class": start.group(1),
+                "method": start.group(2),
+                "status": "ok",
+                "start": when,
+            }
+            tests.append(running[pid])
+            continue
+        failure = _TEST_FAILURE.match(message)
+        if failure:
+            status = failure.group(1).lower()
+            if failure.group(2):
+                cls, method = failure.group(2), failure.group(3)
+            else:
+                method, path = failure.group(4), failure.group(5).split(".")
+                cls = path[-2] if path[-1] == method else path[-1]
+            for test in reversed(tests):
+                if (test["class"], test["method"]) == (cls, method):
+                    test["status"] = status
+                    break
+    for test in running.values():
+        test["duration"] = round(when - test.pop("start"), 3)
+    return tests
+
+
+def _harvest_test_logs(log_paths):
+    """Store the test durations found in `log_paths` in the test history."""
+    tests = []
+    for log_path in log_paths:
+        try:
+            with open(str(log_path), errors="replace") as fd:
+                tests.extend(_parse_test_log(fd))
+        except IOError:
+            continue
+    if not tests:
+        return
+    try:
+        with open(str(TEST_HISTORY_FILE)) as fd:
+            history = fd.readlines()
+    except IOError:
+        history = []
+    history.append(json.dumps({"time": time.time(), "tests": tests}) + "\n")
+    tmp_file = TEST_HISTORY_FILE.with_suffix(".tmp")
+    with open(str(tmp_file), "w") as fd:
+        fd.writelines(history[-TEST_HISTORY_RUNS:])
+    os.replace(str(tmp_file), str(TEST_HISTORY_FILE))
+    _logger.info(
+        "%d tests in %.1fs, %d failed. See `invoke test-report`",
+        len(tests),
+        sum(test["duration"] for test in tests),
+        sum(1 for test in tests if test["status"] != "ok"),
+    )
+
+
+def _psql(c, sql, database="postgres"):
+    """Run `sql` in the `db` service and return the output rows."""
+    cmd = "docker compose exec -T db psql -U {} -d {} -tAc {}".format(
+        DB_USER, database, shlex.quote(sql)
+    )
+    with c.cd(str(PROJECT_ROOT)):
+        return c.run(cmd, hide=True, in_stream=False).stdout.splitlines()
+
+
+def _drop_databases(c, databases):
+    """Drop `databases` and their filestores."""
+    if not databases:
+        return
+    for database in databases:
+        _psql(c, 'DROP DATABASE IF EXISTS "{}"'.format(database))
+    filestores = " ".join(
+        "/var/lib/odoo/filestore/{}".format(database) for database in databases
+    )
+    with c.cd(str(PROJECT_ROOT)):
+        c.run(
+            "docker compose run --rm --no-deps -T odoo rm -rf {}".format(filestores),
+            env=_override_docker_env(),
+            hide=True,
+            in_stream=False,
+        )
+
+
+def _addons_by_name():
+    """Map addon names to their index entries, preferring private addons."""
+    result = {}
+    for addon in _addons_index().values():
+        if addon["name"] not in result or addon["repo"] == PRIVATE:
+            result[addon["name"]] = addon
+    return result
+
+
+def _dependency_closure(addons):
+    """Return `addons` plus all their direct and indirect dependencies."""
+    by_name = _addons_by_name()
+    result = set()
+    pending = list(addons)
+    while pending:
+        addon = pending.pop()
+        if addon in result:
+            continue
+        result.add(addon)
+        pending.extend(by_name.get(addon, {}).get("depends", ()))
+    return result
+
+
+def _shard_modules(modules_list, shards):
+    """Split `modules_list` in up to `shards` dependency-safe groups.
+
+    Modules depending on each other always end up in the same group, so no
+    module gets installed and tested twice. Groups are balanced by the size
+    of their dependency closure, as a proxy of their installation time.
+    """
+    closures = {m: _dependency_closure([m]) for m in modules_list}
+    # Join modules that depend on each other (union-find)
+    parents = {m: m for m in modules_list}
+
+    def find(module):
+        while parents[module] != module:
+            parents[module] = parents[parents[module]]
+            module = parents[module]
+        return module
+
+    for module, closure in closures.items():
+        for dependency in closure & set(modules_list):
+            parents[find(dependency)] = find(module)
+    components = {}
+    for module in modules_list:
+        components.setdefault(find(module), []).append(module)
+    groups = [[] for _ in range(min(shards, len(components)))]
+    weights = [set() for _ in groups]
+    for component in sorted(
+        components.values(),
+        key=lambda ms: len(set().union(*(closures[m] for m in ms))),
+        reverse=True,
+    ):
+        lightest = min(range(len(groups)), key=lambda i: len(weights[i]))
+        groups[lightest].extend(component)
+        weights[lightest].update(*(closures[m] for m in component))
+    return [sorted(group) for group in groups]
+
+
+def _test_template_addons(modules_list, extra_addons=()):
+    """Return the addons that can be preinstalled for testing `modules_list`.
+
+    That is their dependency closure (plus `extra_addons`), without anything
+    that would install one of the modules under test as a side effect.
+    """
+    tested = set(modules_list)
+    candidates = _dependency_closure(tested | set(extra_addons)) - tested
+    return sorted(a for a in candidates if not _dependency_closure([a]) & tested)
+
+
+def _test_template_key(addons):
+    """Cache key of a template database with `addons` installed.
+
+    The index only notices changes of manifests, so the addons are
+    fingerprinted again: editing any of their files changes the key.
+    """
+    by_name = _addons_by_name()
+    key = hashlib.sha1(
+        "{} {}".format(ODOO_VERSION, os.environ.get("DOODBA_WITHOUT_DEMO")).encode()
+    )
+    for addon in addons:
+        entry = by_name.get(addon)
+        fingerprint = (
+            _addon_fingerprint(SRC_PATH / entry["repo"] / addon) if entry else None
+        )
+        key.update(
+            "\n{} {} {}".format(addon, entry and entry["version"], fingerprint).encode()
+        )
+    return key.hexdigest()[:16]
+
+
+def _test_template(c, addons):
+    """Return a template database with `addons` installed, building it if needed.
+
+    Templates are tracked in `odoo/auto/test-templates.json`, and the least
+    recently used ones are dropped beyond `TEST_TEMPLATES_MAX`.
+    """
+    registry = {}
+    if TEST_TEMPLATES_FILE.exists():
+        with open(str(TEST_TEMPLATES_FILE)) as fd:
+            registry = json.load(fd)
+    template = "test_template_{}".format(_test_template_key(addons))
+    exists = _psql(c, "SELECT 1 FROM pg_database WHERE datname = '{}'".format(template))
+    if not (template in registry and exists):
+        _logger.info("Building template database %s", template)
+        _drop_databases(c, [template])
+        _psql(c, 'CREATE DATABASE "{}" OWNER "{}"'.format(template, DB_USER))
+        odoo_command = ["odoo", "--stop-after-init", "--workers=0"]
+        odoo_command += ["-i", ",".join(addons or ["base"])]
+        with c.cd(str(PROJECT_ROOT)):
+            result = c.run(
+                "docker compose run --rm -e PGDATABASE={} odoo {}".format(
+                    template, " ".join(odoo_command)
+                ),
+                env=_override_docker_env(),
+                pty=True,
+                warn=True,
+            )
+        if result.failed:
+            _drop_databases(c, [template])
+            raise exceptions.Exit(
+                "Could not build template database", code=result.exited
+            )
+        registry[template] = {"addons": addons, "created": time.time()}
+    registry[template]["used"] = time.time()
+    # Evict least recently used templates
+    by_usage = sorted(registry, key=lambda t: registry[t]["used"], reverse=True)
+    evicted = by_usage[TEST_TEMPLATES_MAX:]
+    _drop_databases(c, evicted)
+    for name in evicted:
+        del registry[name]
+    with open(str(TEST_TEMPLATES_FILE), "w") as fd:
+        json.dump(registry, fd, indent=2)
+    return template
+
+
+def _create_test_databases(c, databases, template=None):
+    """Create `databases`, cloning `template` and its filestore if given."""
+    sql = 'CREATE DATABASE "{}" OWNER "{}"'
+    if template:
+        sql += ' TEMPLATE "{}"'.format(template)
+    for database in databases:
+        _psql(c, sql.format(database, DB_USER))
+    if template and databases:
+        # Filestore files are never modified in place, hardlinks are safe
+        source = "/var/lib/odoo/filestore/{}".format(template)
+        copies = " && ".join(
+            "cp -al {} /var/lib/odoo/filestore/{}".format(source, database)
+            for database in databases
+        )
+        with c.cd(str(PROJECT_ROOT)):
+            c.run(
+                "docker compose run --rm --no-deps -T odoo sh -c {}".format(
+                    shlex.quote("if [ -d {} ]; then {}; fi".format(source, copies))
+                ),
+                env=_override_docker_env(),
+                hide=True,
+                in_stream=False,
+            )
+
+
+def _test_isolated(
+    c,
+    modules_list,
+    mode,
+    coverage,
+    shards=1,
+    template_cache=False,
+    template_addons="",
+    coverage_contexts=False,
+):
+    """Run tests for `modules_list` in temporary databases.
+
+    Modules are split in `shards` groups tested concurrently. With
+    `template_cache`, the databases are cloned from a cached template that
+    already has all the dependencies installed.
+    """
+    if mode != "init":
+        raise exceptions.ParseError(
+            msg="Isolated test runs use new databases, only 'init' mode is supported."
+        )
+    modules_list = [module for module in modules_list if module]
+    if not modules_list:
+        _logger.warning("No modules to test, nothing to do")
+        return
+    logs_path = TEST_LOGS_PATH
+    logs_path.mkdir(parents=True, exist_ok=True)
+    groups = _shard_modules(modules_list, shards)
+    databases = [
+        "test_{}_shard{}".format(os.getpid(), i) for i in range(1, len(groups) + 1)
+    ]
+
+    def run_shard(shard):
+        group, database = groups[shard], databases[shard]
+        odoo_command = _test_odoo_command(
+            group,
+            mode,
+            coverage,
+            contexts=coverage_contexts,
+        )
+        cmd = ["docker compose", "--compatibility", "run", "--rm", "-T"]
+        cmd.extend(["-e", "PGDATABASE={}".format(database), "odoo"])
+        cmd.extend(odoo_command)
+        start = time.time()
+        with open(str(logs_path / "{}.log".format(database)), "w") as log:
+            result = c.run(
+                " ".join(cmd),
+                env=_override_docker_env(),
+                warn=True,
+                in_stream=False,
+                # Stream the output as well when running a single shard
+                out_stream=log if len(groups) > 1 else _Tee(sys.stdout, log),
+                err_stream=log if len(groups) > 1 else _Tee(sys.stderr, log),
+            )
+        return result.exited, time.time() - start
+
+    with c.cd(str(PROJECT_ROOT)):
+        c.run("docker compose up -d db", hide=True)
+    template = None
+    if template_cache:
+        extra_addons = template_addons.split(",") if template_addons else []
+        with _timed("phase", "test template"):
+            template = _test_template(
+                c, _test_template_addons(modules_list, extra_addons)
+            )
+    try:
+        with _timed("phase", "create databases"):
+            _create_test_databases(c, databases, template)
+        with _timed("phase", "run tests"), c.cd(str(PROJECT_ROOT)):
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                results = list(executor.map(run_shard, range(len(groups))))
+    finally:
+        with _timed("phase", "drop databases"):
+            _drop_databases(c, databases)
+
+    # Merge logs
+    with open(str(logs_path / "test.log"), "w") as merged:
+        for database in databases:
+            merged.write("==> {} <==\n".format(database))
+            with open(str(logs_path / "{}.log".format(database))) as log:
+                shutil.copyfileobj(log, merged)
+    _harvest_test_logs(logs_path / "{}.log".format(database) for database in databases)
+    msg = ["Test results, logs in {}:".format(logs_path / "test.log")]
+    for group, (exited, duration) in zip(groups, results):
+        msg.append(
+            "  {} {:>8.1f}s  {}".format(
+                "FAIL" if exited else "OK", duration, ",".join(group)
+            )
+        )
+    _logger.info("\n".join(msg))
+    exit_code = max(exited for exited, _ in results)
+    if exit_code:
+        raise exceptions.Exit("Some tests failed", code=exit_code)
+
+
+def _test_daemon_alive():
+    mtime = _mtime(str(TEST_DAEMON_PATH / "heartbeat"))
+    return mtime is not None and time.time() - mtime < 10
+
+
+def _test_daemon_running(c):
+    with c.cd(str(PROJECT_ROOT)):
+        return bool(
+            c.run(
+                "docker ps -q --filter name=^{}$".format(TEST_DAEMON_CONTAINER),
+                hide=True,
+                in_stream=False,
+            ).stdout.strip()
+        )
+
+
+def _test_daemon_stop(c):
+    with c.cd(str(PROJECT_ROOT)):
+        c.run("docker rm -f {}".format(TEST_DAEMON_CONTAINER), hide=True, warn=True)
+    try:
+        (TEST_DAEMON_PATH / "heartbeat").unlink()
+    except OSError:
+        pass
+
+
+def _test_daemon_start(c, database=False):
+    if ODOO_VERSION < 11:
+        raise exceptions.PlatformError(
+            "The test daemon is not available for Doodba environments bellow v11."
         )
-        _override_docker_command(
-            "odoo",
-            odoo_command,
-            file=tmp_docker_compose_file,
+    _test_daemon_stop(c)
+    (TEST_DAEMON_PATH / "jobs").mkdir(parents=True, exist_ok=True)
+    cmd = "docker compose run -d --name {}".format(TEST_DAEMON_CONTAINER)
+    if database:
+        cmd += " -e PGDATABASE={}".format(database)
+    cmd += " odoo python /opt/odoo/custom/hack/test_daemon.py --workers=0"
+    with c.cd(str(PROJECT_ROOT)):
+        c.run(cmd, env=_override_docker_env(), hide=True)
+    _logger.info("Waiting for the test daemon to load the registry...")
+    if _wait_until(_test_daemon_alive, time.time() + SERVICES_READY_TIMEOUT) is None:
+        raise exceptions.Exit(
+            "Test daemon not ready, see `docker logs {}`".format(TEST_DAEMON_CONTAINER)
         )
-        with c.cd(str(PROJECT_ROOT)):
-            c.run(
-                cmd,
-                env=dict(
-                    _override_docker_env(database),
-                    DOODBA_DEBUGPY_ENABLE="1",
-                ),
-                pty=True,
-            )
-        _logger.info("Waiting for services to spin up...")
-        time.sleep(SERVICES_WAIT_TIME)
-
 
-def _get_module_list(
-    c,
-    modules=None,
-    core=False,
-    extra=False,
-    private=False,
-    enterprise=False,
-    only_installable=True,
-):
-    """Returns a list of addons according to the passed parameters.
 
-    By default, refers to the addon from directory being worked on,
-    unless other options are specified.
-    """
-    # Get list of dependencies for addon
-    cmd = "docker compose --compatibility run --rm odoo addons list"
-    if core:
-        cmd += " --core"
-    if extra:
-        cmd += " --extra"
-    if private:
-        cmd += " --private"
-    if enterprise:
-        cmd += " --enterprise"
-    if modules:
-        cmd += f" -w {modules}"
-    if only_installable:
-        cmd += " --installable"
-    with c.cd(str(PROJECT_ROOT)):
-        module_list = c.run(
-            cmd,
-            env=UID_ENV,
-            pty=True,
-            hide="stdout",
-        ).stdout.splitlines()[-1]
-    return module_list
+def _test_in_daemon(c, modules_list, mode, database, retry=True):
+    """Run tests in the test daemon, streaming their log."""
+    job_id = "{}-{}".format(int(time.time() * 1000), os.getpid())
+    job = {
+        "id": job_id,
+        "modules": modules_list,
+        "mode": mode,
+        "database": database or None,
+        "test_tags": "/" + ",/".join(modules_list) if ODOO_VERSION >= 12 else None,
+    }
+    job_path = TEST_DAEMON_PATH / "jobs" / "{}.json".format(job_id)
+    with open(str(job_path.with_suffix(".tmp")), "w") as fd:
+        json.dump(job, fd)
+    os.replace(str(job_path.with_suffix(".tmp")), str(job_path))
+    log_path = TEST_DAEMON_PATH / "{}.log".format(job_id)
+    result_path = TEST_DAEMON_PATH / "{}.result".format(job_id)
+    position, checked = 0, time.time()
+    while True:
+        done = result_path.exists()
+        if log_path.exists():
+            with open(str(log_path)) as fd:
+                fd.seek(position)
+                sys.stdout.write(fd.read())
+                sys.stdout.flush()
+                position = fd.tell()
+        if done:
+            break
+        if time.time() - checked > 5:
+            if not _test_daemon_running(c):
+                raise exceptions.Exit("The test daemon stopped unexpectedly")
+            checked = time.time()
+        time.sleep(0.2)
+    with open(str(result_path)) as fd:
+        result = json.load(fd)
+    result_path.unlink()
+    if log_path.exists():
+        TEST_LOGS_PATH.mkdir(parents=True, exist_ok=True)
+        os.replace(str(log_path), str(TEST_LOGS_PATH / "daemon.log"))
+        _harvest_test_logs([TEST_LOGS_PATH / "daemon.log"])
+    if result["status"] == "stale":
+        if not retry:
+            raise exceptions.Exit("The test daemon could not load fresh code")
+        _logger.info("%s changed, restarting the test daemon", result["file"])
+        _test_daemon_start(c, database)
+        return _test_in_daemon(c, modules_list, mode, database, retry=False)
+    if result["exit_code"]:
+        raise exceptions.Exit("Some tests failed", code=result["exit_code"])
 
 
-def _test_inject_coverage(odoo_command, modules_list):
-    # Inject coverage into the command
-    coverage_paths = ",".join(
-        map(lambda m: "/opt/odoo/custom/src/private/{}".format(m), modules_list)
-    )
-    if coverage_paths:
-        odoo_command[0] = "/usr/local/bin/odoo"
-        odoo_command = [
-            "coverage",
-            "run",
-            "--data-file=/opt/odoo/auto/.coverage",
-            "--source={}".format(coverage_paths),
-        ] + odoo_command
+@task(
+    help={
+        "stop": "Stop the test daemon instead of starting it",
+        "database": "Database to warm up. Defaults to $PGDATABASE",
+    },
+)
+def test_daemon(c, stop=False, database=False):
+    """Start a test daemon, that keeps Odoo loaded between `invoke test` runs
 
-    return odoo_command
+    It restarts itself whenever any Python file it loaded changes.
+    """
+    if stop:
+        _test_daemon_stop(c)
+    else:
+        _test_daemon_start(c, database)
 
 
 @task(
@@ -383,6 +2218,16 @@ def _test_inject_coverage(odoo_command, modules_list):
         "mode": "Mode in which tests run. Options: ['init'(default), 'update']",
         "database": "Database to run against. Defaults to $PGDATABASE",
         "coverage": "Generate a coverage.py output",
+        "coverage-contexts": "With --coverage, record which test covers each line."
+        " Slower, as it needs the classic tracer. Default: False",
+        "shards": "Split the modules in this many dependency-safe groups, tested"
+        " concurrently in separate temporary databases. Default: 1",
+        "template-cache": "Test in a temporary database cloned from a cached"
+        " template with all dependencies preinstalled. Default: False",
+        "template-addons": "Comma-separated list of extra addons to preinstall in"
+        " the cached template, i.e. l10n_generic_coa",
+        "daemon": "Run the tests in the test daemon, if it is running."
+        " See test-daemon. Default: True",
     },
 )
 def test(
@@ -398,6 +2243,11 @@ def test(
     mode="init",
     database=False,
     coverage=False,
+    shards=1,
+    template_cache=False,
+    template_addons="",
+    daemon=True,
+    coverage_contexts=False,
 ):
     """Run Odoo tests
 
@@ -418,15 +2268,6 @@ def test(
         modules = cur_module
     else:
         modules = _get_module_list(c, modules, core, extra, private, enterprise)
-    odoo_command = ["odoo", "--test-enable", "--stop-after-init", "--workers=0"]
-    if mode == "init":
-        odoo_command.append("-i")
-    elif mode == "update":
-        odoo_command.append("-u")
-    else:
-        raise exceptions.ParseError(
-            msg="Available modes are 'init' or 'update'. See --help for details."
-        )
     # Skip test in some modules
     modules_list = modules.split(",")
     for m_to_skip in skip.split(","):
@@ -437,50 +2278,82 @@ def test(
                 "%s not found in the list of addons to test: %s", m_to_skip, modules
             )
         modules_list.remove(m_to_skip)
-    modules = ",".join(modules_list)
-    odoo_command.append(modules)
 
-    if coverage and modules_list:
+    if coverage_contexts and not coverage:
+        raise exceptions.ParseError(msg="--coverage-contexts requires --coverage")
+    if coverage and modules_list and debugpy:
+        raise exceptions.ParseError(
+            msg="Coverage cannot run at the same time as debugpy"
+        )
+    if shards > 1 or template_cache:
         if debugpy:
             raise exceptions.ParseError(
-                msg="Coverage cannot run at the same time as debugpy"
+                msg="Isolated tests cannot run at the same time as debugpy"
             )
-        odoo_command = _test_inject_coverage(odoo_command, modules_list)
-
-    if ODOO_VERSION >= 12:
-        # Limit tests to explicit list
-        # Filter spec format (comma-separated)
-        # [-][tag][/module][:class][.method]
-        odoo_command.extend(["--test-tags", "/" + ",/".join(modules_list)])
+        return _test_isolated(
+            c,
+            modules_list,
+            mode,
+            coverage,
+            shards,
+            template_cache,
+            template_addons,
+            coverage_contexts,
+        )
+    odoo_command = _test_odoo_command(
+        modules_list, mode, coverage, contexts=coverage_contexts
+    )
+    if daemon and not (debugpy or coverage) and _test_daemon_alive():
+        return _test_in_daemon(c, modules_list, mode, database)
     if debugpy:
         _test_in_debug_mode(c, odoo_command, database)
     else:
         cmd = ["docker compose", "--compatibility", "run", "--rm"]
         cmd.append("odoo")
         cmd.extend(odoo_command)
-        with c.cd(str(PROJECT_ROOT)):
-            c.run(
-                " ".join(cmd),
-                env=_override_docker_env(database),
-                pty=True,
-            )
+        TEST_LOGS_PATH.mkdir(parents=True, exist_ok=True)
+        log_path = TEST_LOGS_PATH / "test.log"
+        try:
+            with c.cd(str(PROJECT_ROOT)), open(str(log_path), "w") as log:
+                c.run(
+                    " ".join(cmd),
+                    env=_override_docker_env(database),
+                    pty=True,
+                    out_stream=_Tee(sys.stdout, log),
+                )
+        finally:
+            _harvest_test_logs([log_path])
 
 
 @task(
     help={
         "format": "Format to generate a coverage report in",
+        "contexts": "Show the tests covering each line in the html report",
     }
 )
-def test_coverage_report(c, format=None):
+def test_coverage_report(c, format=None, contexts=False):
     if format is None:
         format = "html"
 
-    if not (PROJECT_ROOT / "odoo" / "auto" / ".coverage").exists():
+    auto_path = PROJECT_ROOT / "odoo" / "auto"
+    parallel_files = list(auto_path.glob(".coverage.*"))
+    if not (parallel_files or (auto_path / ".coverage").exists()):
         _logger.warning("Coverage input file does not exist, skipping")
         return
 
+    if parallel_files:
+        # Replace the previous report data with the runs since then
+        with c.cd(str(PROJECT_ROOT)):
+            c.run(
+                "docker compose run --rm odoo coverage combine"
+                " --data-file=/opt/odoo/auto/.coverage",
+                env=UID_ENV,
+                pty=True,
+            )
+
     FORMAT_TO_COMMAND = {
-        "html": "html -d /opt/odoo/auto/coverage",
+        "html": "html -d /opt/odoo/auto/coverage"
+        + (" --show-contexts" if contexts else ""),
         "xml": "xml -o /opt/odoo/auto/coverage.xml",
         "report": "report",
     }
@@ -500,6 +2373,66 @@ def test_coverage_report(c, format=None):
         )
 
 
+@task(
+    help={
+        "slowest": "Number of tests to show",
+        "group": "Group durations by 'method', 'class' or 'module'",
+        "runs": "Number of recent test runs to consider",
+    },
+)
+def test_report(c, slowest=20, group="method", runs=10):
+    """Show the slowest tests, from the durations recorded by `invoke test`."""
+    fields = {"module": 1, "class": 2, "method": 3}
+    if group not in fields:
+        raise exceptions.ParseError(
+            msg="Available groups are 'method', 'class' or 'module'."
+        )
+    try:
+        with open(str(TEST_HISTORY_FILE)) as fd:
+            history = [json.loads(line) for line in fd if line.strip()][-runs:]
+    except (IOError, ValueError):
+        history = []
+    if not history:
+        _logger.warning("No test durations recorded yet, run `invoke test` first")
+        return
+    durations, failures, totals = {}, {}, []
+    for run in history:
+        run_durations = {}
+        for test in run["tests"]:
+            key = ".".join(
+                test[field] for field in ("module", "class", "method")[: fields[group]]
+            )
+            run_durations[key] = run_durations.get(key, 0) + test["duration"]
+            if test["status"] != "ok":
+                failures[key] = failures.get(key, 0) + 1
+        for key, duration in run_durations.items():
+            durations.setdefault(key, []).append(duration)
+        totals.append(sum(run_durations.values()))
+    total = _percentile(totals, 50)
+    medians = {key: _percentile(values, 50) for key, values in durations.items()}
+    print(
+        "Slowest tests over the last {} runs, of {:.1f}s in total:".format(
+            len(history), total
+        )
+    )
+    print(
+        "{:>9} {:>9} {:>6} {:>5} {:>6}  {}".format(
+            "median", "max", "share", "runs", "fails", group
+        )
+    )
+    for key in sorted(medians, key=medians.get, reverse=True)[:slowest]:
+        print(
+            "{:>8.2f}s {:>8.2f}s {:>5.1f}% {:>5} {:>6}  {}".format(
+                medians[key],
+                max(durations[key]),
+                100 * medians[key] / total if total else 0,
+                len(durations[key]),
+                failures.get(key, 0),
+                key,
+            )
+        )
+
+
 @task()
 def stop(c):
     """Stop environment."""
@@ -508,42 +2441,247 @@ def stop(c):
         c.run(cmd, pty=True)
 
 
-@task()
-def restart(c, quick=True):
+@task(
+    help={
+        "services": "Comma-separated list of services to restart."
+        " Default: odoo and its proxy"
+    },
+)
+def restart(c, quick=True, services=None):
     """Restart odoo container(s)."""
+    if services:
+        services = services.split(",")
+    else:
+        state = _compose_state(c)
+        services = [s for s in ("odoo",) + PROXY_SERVICES["odoo"] if s in state] or [
+            "odoo"
+        ]
     cmd = "docker compose --compatibility restart"
     if quick:
         cmd = f"{cmd} -t0"
-    cmd = f"{cmd} odoo odoo_proxy"
+    cmd = f"{cmd} {' '.join(services)}"
     with c.cd(str(PROJECT_ROOT)):
         c.run(cmd, env=_override_docker_env(), pty=True)
 
 
+# Odoo's werkzeug lines end with the query count, SQL time and Python time
+_WERKZEUG_REQUEST = re.compile(
+    r'"([A-Z]+) (\S+) HTTP/[\d.]+" (\d{3}) \S+ (\d+) ([\d.]+) ([\d.]+)'
+)
+# Requests with many fast queries usually issue one query per record
+N_PLUS_ONE_MIN_QUERIES = int(os.environ.get("N_PLUS_ONE_MIN_QUERIES", 50))
+N_PLUS_ONE_MAX_QUERY_TIME = float(os.environ.get("N_PLUS_ONE_MAX_QUERY_TIME", 0.002))
+
+
+class _RequestStats:
+    """File-like object computing per-route latency stats from Odoo logs.
+
+    Keeps the last `window` requests of each route, and prints the stats
+    table every `interval` seconds if given.
+    """
+
+    def __init__(self, window=1000, interval=None, top=20):
+        self.window = window
+        self.interval = interval
+        self.top = top
+        self.routes = {}
+        self.n_plus_one = {}
+        self.pending = ""
+        self.printed = time.time()
+
+    def write(self, data):
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.add(_ANSI_ESCAPE.sub("", line))
+        if self.interval and time.time() - self.printed > self.interval:
+            if sys.stdout.isatty():
+                sys.stdout.write("\x1b[2J\x1b[H")
+            self.print_table()
+
+    def flush(self):
+        pass
+
+    def add(self, line):
+        match = _WERKZEUG_REQUEST.search(line)
+        if not match:
+            return
+        method, path, status, queries, sql_time, python_time = match.groups()
+        # Group requests to the same record, i.e. /web/content/42
+        path = re.sub(r"/\d+(?=/|$)", "/<id>", path.split("?", 1)[0])
+        route = "{} {}".format(method, path)
+        queries, sql_time = int(queries), float(sql_time)
+        samples = self.routes.setdefault(route, [])
+        samples.append((sql_time + float(python_time), queries, sql_time))
+        del samples[: -self.window]
+        if (
+            queries >= N_PLUS_ONE_MIN_QUERIES
+            and sql_time / queries <= N_PLUS_ONE_MAX_QUERY_TIME
+        ):
+            self.n_plus_one[route] = self.n_plus_one.get(route, 0) + 1
+
+    def print_table(self):
+        self.printed = time.time()
+        if not self.routes:
+            print("No Odoo requests with timings found")
+            return
+        print(
+            "{:<60} {:>6} {:>8} {:>8} {:>8} {:>6} {:>6} {:>5} {:>5}".format(
+                "route", "count", "p50", "p95", "p99", "q p50", "q p95", "sql%", "n+1"
+            )
+        )
+        stats = []
+        for route, samples in self.routes.items():
+            latencies = [latency for latency, _, _ in samples]
+            queries = [count for _, count, _ in samples]
+            stats.append(
+                (
+                    _percentile(latencies, 95),
+                    route,
+                    len(samples),
+                    latencies,
+                    queries,
+                    sum(sql for _, _, sql in samples) / (sum(latencies) or 1),
+                )
+            )
+        for p95, route, count, latencies, queries, sql_share in sorted(
+            stats, reverse=True
+        )[: self.top]:
+            print(
+                "{:<60} {:>6} {:>6.0f}ms {:>6.0f}ms {:>6.0f}ms"
+                " {:>6} {:>6} {:>4.0f}% {:>5}".format(
+                    route[:60],
+                    count,
+                    _percentile(latencies, 50) * 1000,
+                    p95 * 1000,
+                    _percentile(latencies, 99) * 1000,
+                    _percentile(queries, 50),
+                    _percentile(queries, 95),
+                    sql_share * 100,
+                    self.n_plus_one.get(route, ""),
+                )
+            )
+        sys.stdout.flush()
+
+
 @task(
     help={
         "container": "Names of the containers from which logs will be obtained."
         " You can specify a single one, or several comma-separated names."
-        " Default: None (show logs for all containers)"
+        " Default: None (show logs for all containers)",
+        "analyze": "Instead of printing the logs, show per-route latency and"
+        " query count stats of Odoo requests, flagging N+1-looking ones",
+        "interval": "With --analyze and --follow, seconds between stats tables."
+        " Default: 5",
     },
 )
-def logs(c, tail=10, follow=True, container=None):
+def logs(c, tail=10, follow=True, container=None, analyze=False, interval=5):
     """Obtain last logs of current environment."""
     cmd = "docker compose --compatibility logs"
     if follow:
         cmd += " -f"
     if tail:
         cmd += f" --tail {tail}"
+    if analyze:
+        cmd += " --no-color --no-log-prefix"
     if container:
         cmd += f" {container.replace(',', ' ')}"
     with c.cd(str(PROJECT_ROOT)):
-        c.run(cmd, pty=True)
+        if not analyze:
+            c.run(cmd, pty=True)
+            return
+        stats = _RequestStats(interval=interval if follow else None)
+        try:
+            c.run(cmd, out_stream=stats, warn=True)
+        finally:
+            stats.write("\n")
+            stats.print_table()
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _read_timings(name=None, last=50):
+    """Return the timing records of the last `last` runs of task `name`."""
+    try:
+        with open(str(TIMINGS_FILE)) as fd:
+            records = [json.loads(line) for line in fd if line.strip()]
+    except (IOError, ValueError):
+        records = []
+    runs = [
+        r["run"]
+        for r in records
+        if r["kind"] == "task"
+        and r["name"] == r["task"]
+        and r["run"]
+        and (not name or r["task"] == name)
+    ]
+    runs = set(runs[-last:])
+    return [r for r in records if r["run"] in runs]
+
+
+@task(
+    klass=Task,
+    help={
+        "name": "Only show this task, with the timings of its phases and commands",
+        "last": "Number of recent runs of each task to consider",
+        "trace": "Export the timings to this file, in Chrome trace format, to"
+        " open in https://ui.perfetto.dev or chrome://tracing",
+    },
+)
+def timings(c, name=None, last=50, trace=None):
+    """Show p50/p95 wall times of recent task runs."""
+    records = _read_timings(name, last)
+    if not records:
+        _logger.warning("No timings recorded in %s", TIMINGS_FILE)
+        return
+    if trace:
+        events = [
+            {
+                "name": r["name"],
+                "cat": r["kind"],
+                "ph": "X",
+                "ts": int(r["start"] * 1e6),
+                "dur": int(r["duration"] * 1e6),
+                "pid": r["pid"],
+                "tid": r["tid"],
+                "args": {k: r[k] for k in ("task", "command", "exit_code") if k in r},
+            }
+            for r in records
+        ]
+        with open(trace, "w") as fd:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fd)
+        _logger.info("Trace of %d events written to %s", len(events), trace)
+        return
+    groups = {}
+    for r in records:
+        if r["kind"] == "task" and r["name"] == r["task"]:
+            groups.setdefault((r["task"], ""), []).append(r)
+        elif name:
+            groups.setdefault((r["task"], r["name"]), []).append(r)
+    print("{:<50} {:>5} {:>6} {:>9} {:>9}".format("", "runs", "fails", "p50", "p95"))
+    for (task_name, step), rows in sorted(groups.items()):
+        durations = [r["duration"] for r in rows]
+        print(
+            "{:<50} {:>5} {:>6} {:>8.1f}s {:>8.1f}s".format(
+                "  " + step[:48] if step else task_name,
+                len(rows),
+                sum(1 for r in rows if r["exit_code"]),
+                _percentile(durations, 50),
+                _percentile(durations, 95),
+            )
+        )
 
 
 @task()
 def stopstart(c, quick=False, detach=True, debugpy=False):
     """Stop the environment, then start it again"""
-    result = c.run("docker compose ps --format=json", hide=True)
-    if result.stdout != "[]" and quick:
+    running = any(
+        container.state == "running" for container in _compose_state(c).values()
+    )
+    if running and quick:
         c.run("docker compose --compatibility stop -t0 odoo", pty=True)
         start(c, detach, debugpy)
     else:
@@ -563,6 +2701,251 @@ def psql(c, db=None):
     c.run(cmd, pty=True)
 
 
+def _terminate_connections(c, database):
+    _psql(
+        c,
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity"
+        " WHERE datname = '{}' AND pid <> pg_backend_pid()".format(database),
+    )
+
+
+@contextmanager
+def _odoo_stopped(c):
+    """Stop the odoo service during the block, so it cannot reconnect."""
+    with c.cd(str(PROJECT_ROOT)):
+        running = c.run(
+            "docker compose ps -q --status running odoo", hide=True, warn=True
+        ).stdout.strip()
+        if running:
+            c.run("docker compose stop odoo", hide=True)
+    try:
+        yield
+    finally:
+        if running:
+            with c.cd(str(PROJECT_ROOT)):
+                c.run("docker compose start odoo", hide=True)
+
+
+def _run_in_odoo(c, script):
+    """Run the shell `script` in a throwaway odoo container."""
+    with c.cd(str(PROJECT_ROOT)):
+        c.run(
+            "docker compose run --rm -T odoo sh -c {}".format(shlex.quote(script)),
+            env=_override_docker_env(),
+            in_stream=False,
+        )
+
+
+def _read_snapshots():
+    """Return the metadata of every snapshot, oldest first."""
+    snapshots = []
+    for path in SNAPSHOTS_PATH.glob("*/snapshot.json"):
+        with open(str(path)) as fd:
+            snapshots.append(json.load(fd))
+    return sorted(snapshots, key=lambda snapshot: snapshot["created"])
+
+
+def _remove_snapshots(c, snapshots):
+    for snapshot in snapshots:
+        if snapshot["mode"] == "template":
+            _terminate_connections(c, snapshot["template"])
+            _psql(c, 'DROP DATABASE IF EXISTS "{}"'.format(snapshot["template"]))
+    if snapshots:
+        _run_in_odoo(
+            c,
+            "rm -rf {}".format(
+                " ".join(
+                    "/var/lib/odoo/snapshots/{} /opt/odoo/auto/snapshots/{}".format(
+                        snapshot["name"], snapshot["name"]
+                    )
+                    for snapshot in snapshots
+                )
+            ),
+        )
+
+
+def _human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TB"
+    return "{:.1f}{}".format(size, unit)
+
+
+@task(
+    help={
+        "name": "Name of the snapshot. Defaults to the database and current time",
+        "db": "Database to snapshot. Defaults to $PGDATABASE",
+        "template": "Clone the database in the same cluster with CREATE DATABASE"
+        " ... TEMPLATE instead of dumping it. Faster, but uses database space."
+        " Stops odoo and closes any other session on the database while cloning",
+        "jobs": "Parallel jobs used by pg_dump. Default: 4",
+    },
+)
+def db_snapshot(c, name=None, db=None, template=False, jobs=4):
+    """Snapshot a database and its filestore.
+
+    Dumps use pg_dump's directory format in `odoo/auto/snapshots`, and the
+    filestore is hardlinked inside the filestore volume.
+    """
+    database = db or DB_NAME
+    name = name or "{}-{}".format(database, time.strftime("%Y%m%d-%H%M%S"))
+    if not re.match(r"^[\w.-]+$", name):
+        raise exceptions.ParseError(msg=f"Invalid snapshot name {name}")
+    if (SNAPSHOTS_PATH / name).exists():
+        raise exceptions.ParseError(msg=f"Snapshot {name} already exists")
+    snapshot = {
+        "name": name,
+        "database": database,
+        "mode": "template" if template else "dump",
+        "created": time.time(),
+    }
+    with c.cd(str(PROJECT_ROOT)):
+        c.run("docker compose up -d db", hide=True)
+    (SNAPSHOTS_PATH / name).mkdir(parents=True)
+    # Odoo never modifies filestore files in place, hardlinks are safe
+    script = (
+        "if [ -d /var/lib/odoo/filestore/{0} ]; then"
+        " mkdir -p /var/lib/odoo/snapshots"
+        " && cp -al /var/lib/odoo/filestore/{0} /var/lib/odoo/snapshots/{1}; fi"
+    ).format(database, name)
+    try:
+        if template:
+            snapshot["template"] = "snapshot_{}".format(name)
+            with _odoo_stopped(c):
+                _terminate_connections(c, database)
+                _psql(
+                    c,
+                    'CREATE DATABASE "{}" TEMPLATE "{}"'.format(
+                        snapshot["template"], database
+                    ),
+                )
+            snapshot["size"] = int(
+                _psql(c, "SELECT pg_database_size('{}')".format(snapshot["template"]))[
+                    0
+                ]
+            )
+        else:
+            script = (
+                "pg_dump -Fd -j {} -f /opt/odoo/auto/snapshots/{}/dump {} && {}".format(
+                    jobs, name, database, script
+                )
+            )
+        _run_in_odoo(c, script)
+        if not template:
+            snapshot["size"] = sum(
+                path.stat().st_size
+                for path in (SNAPSHOTS_PATH / name / "dump").iterdir()
+            )
+    except BaseException:
+        _remove_snapshots(c, [snapshot])
+        raise
+    snapshot["duration"] = time.time() - snapshot["created"]
+    with open(str(SNAPSHOTS_PATH / name / "snapshot.json"), "w") as fd:
+        json.dump(snapshot, fd, indent=2)
+    _logger.info(
+        "Snapshot %s of %s created in %.1fs (%s)",
+        name,
+        database,
+        snapshot["duration"],
+        _human_size(snapshot["size"]),
+    )
+
+
+@task(
+    help={
+        "name": "Name of the snapshot to restore",
+        "db": "Database to restore into, replacing it. Defaults to the database"
+        " the snapshot was taken from",
+        "jobs": "Parallel jobs used by pg_restore. Default: 4",
+    },
+)
+def db_restore(c, name, db=None, jobs=4):
+    """Restore a database and its filestore from a snapshot.
+
+    Odoo is stopped during the restore, and any other session on the
+    database (and on the snapshot clone, for template snapshots) is closed.
+    """
+    snapshot = next((s for s in _read_snapshots() if s["name"] == name), None)
+    if not snapshot:
+        raise exceptions.ParseError(msg=f"Snapshot {name} not found")
+    database = db or snapshot["database"]
+    start = time.time()
+    with c.cd(str(PROJECT_ROOT)):
+        c.run("docker compose up -d db", hide=True)
+    sql = 'CREATE DATABASE "{}" OWNER "{}"'.format(database, DB_USER)
+    script = (
+        "if [ -d /var/lib/odoo/snapshots/{0} ]; then"
+        " mkdir -p /var/lib/odoo/filestore"
+        " && cp -al /var/lib/odoo/snapshots/{0} /var/lib/odoo/filestore/{1}; fi"
+    ).format(name, database)
+    with _odoo_stopped(c):
+        _terminate_connections(c, database)
+        _drop_databases(c, [database])
+        if snapshot["mode"] == "template":
+            _terminate_connections(c, snapshot["template"])
+            _psql(c, sql + ' TEMPLATE "{}"'.format(snapshot["template"]))
+        else:
+            _psql(c, sql)
+            script = (
+                "pg_restore -j {} -d {} /opt/odoo/auto/snapshots/{}/dump && {}".format(
+                    jobs, database, name, script
+                )
+            )
+        _run_in_odoo(c, script)
+    _logger.info(
+        "Snapshot %s restored into %s in %.1fs", name, database, time.time() - start
+    )
+
+
+@task()
+def db_snapshot_list(c):
+    """List database snapshots."""
+    snapshots = _read_snapshots()
+    if not snapshots:
+        _logger.warning("No snapshots in %s", SNAPSHOTS_PATH)
+        return
+    for snapshot in snapshots:
+        print(
+            "{:<40} {:<20} {:<8} {} {:>9}".format(
+                snapshot["name"],
+                snapshot["database"],
+                snapshot["mode"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot["created"])),
+                _human_size(snapshot["size"]),
+            )
+        )
+
+
+@task(
+    help={
+        "older-than": "Remove snapshots older than this many days",
+        "max-size": "Remove the oldest snapshots until they use at most this many"
+        " GB. Filestores are hardlinked and not counted",
+        "dry-run": "Only print the snapshots that would be removed",
+    },
+)
+def db_snapshot_prune(c, older_than=None, max_size=None, dry_run=False):
+    """Remove old database snapshots."""
+    if older_than is None and max_size is None:
+        raise exceptions.ParseError(msg="Use --older-than and/or --max-size")
+    snapshots = _read_snapshots()
+    removed = []
+    if older_than is not None:
+        limit = time.time() - float(older_than) * 86400
+        removed = [s for s in snapshots if s["created"] < limit]
+    kept = [s for s in snapshots if s not in removed]
+    if max_size is not None:
+        while kept and sum(s["size"] for s in kept) > float(max_size) * 1024**3:
+            removed.append(kept.pop(0))
+    for snapshot in removed:
+        _logger.info("Removing snapshot %s", snapshot["name"])
+    if not dry_run:
+        _remove_snapshots(c, removed)
+
+
 @task()
 def shell(c, db=None, native=True):
     """
@@ -598,19 +2981,111 @@ def scaffold(c, name):
     c.run(cmd)
 
 
-@task()
-def upgrade(c, db=None, include_core=False):
+def _match_databases(c, patterns):
+    """Return the databases matching any of the comma-separated `patterns`."""
+    patterns = [pattern for pattern in patterns.split(",") if pattern]
+    if not any(set("*?[") & set(pattern) for pattern in patterns):
+        return patterns
+    databases = _psql(
+        c, "SELECT datname FROM pg_database WHERE NOT datistemplate ORDER BY datname"
+    )
+    return [
+        database
+        for database in databases
+        if database != "postgres"
+        and not database.startswith("test_template_")
+        and any(fnmatch(database, pattern) for pattern in patterns)
+    ]
+
+
+_MODULE_LOADED = re.compile(r"Module (\w+) loaded in ([\d.]+)s")
+
+
+def _module_load_times(log_path):
+    """Return how long each module took to load, from an Odoo log."""
+    result = {}
+    with open(str(log_path), errors="replace") as fd:
+        for line in fd:
+            match = _MODULE_LOADED.search(_ANSI_ESCAPE.sub("", line))
+            if match:
+                result[match.group(1)] = float(match.group(2))
+    return result
+
+
+@task(
+    help={
+        "db": "Database to upgrade. Several can be given comma-separated, and they"
+        " can be patterns, i.e. 'customer_*'. Defaults to $PGDATABASE",
+        "include-core": "Upgrade core addons too",
+        "jobs": "How many databases to upgrade at once. Default: 4",
+    },
+)
+def upgrade(c, db=None, include_core=False, jobs=4):
     """
     Upgrade all Odoo addons
     Ignores core addons by default.
     User --include-core to include them
     """
-    cmd = "docker compose exec odoo click-odoo-update"
-    if not include_core:
-        cmd += " --ignore-core-addons"
-    if db:
-        cmd += f" -d {db}"
-    c.run(cmd, pty=True)
+    databases = _match_databases(c, db) if db else [None]
+    if not databases:
+        raise exceptions.ParseError(msg=f"No database matches {db}")
+    UPGRADE_LOGS_PATH.mkdir(parents=True, exist_ok=True)
+    many = len(databases) > 1
+
+    def upgrade_database(database):
+        # Several upgrades can't share the terminal
+        cmd = "docker compose exec {}odoo click-odoo-update".format(
+            "-T " if many else ""
+        )
+        if not include_core:
+            cmd += " --ignore-core-addons"
+        if database:
+            cmd += f" -d {database}"
+        log_path = UPGRADE_LOGS_PATH / "{}.log".format(database or "default")
+        out = _Prefixed(sys.stdout, f"[{database}] " if many else "")
+        err = _Prefixed(sys.stderr, f"[{database}] " if many else "")
+        start = time.time()
+        with open(str(log_path), "w") as log:
+            result = c.run(
+                cmd,
+                pty=not many,
+                warn=True,
+                in_stream=False if many else None,
+                out_stream=_Tee(out, log),
+                err_stream=_Tee(err, log),
+            )
+        out.close()
+        err.close()
+        return {
+            "time": start,
+            "database": database,
+            "duration": time.time() - start,
+            "exit_code": result.exited,
+            "modules": _module_load_times(log_path),
+        }
+
+    with c.cd(str(PROJECT_ROOT)):
+        with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(databases)))) as pool:
+            results = list(pool.map(upgrade_database, databases))
+    with open(str(UPGRADE_HISTORY_FILE), "a") as fd:
+        for result in results:
+            fd.write(json.dumps(result, sort_keys=True) + "\n")
+
+    msg = ["Upgrade results, logs in {}:".format(UPGRADE_LOGS_PATH)]
+    for result in results:
+        slowest = sorted(result["modules"].items(), key=lambda i: i[1], reverse=True)
+        msg.append(
+            "  {:<4} {:>8.1f}s  {}  {}".format(
+                "FAIL" if result["exit_code"] else "OK",
+                result["duration"],
+                result["database"] or "default",
+                ", ".join("{} {:.1f}s".format(*item) for item in slowest[:5]),
+            )
+        )
+    _logger.info("\n".join(msg))
+    exit_code = max(result["exit_code"] for result in results)
+    if exit_code:
+        raise exceptions.Exit("Some upgrades failed", code=exit_code)
 
 
 @task(develop)
@@ -788,15 +3263,16 @@ def preparedb(c, database=False):
     help={
         "base": "Any valid tree-ish to compare against",
         "coverage": "Generate a coverage.py output",
+        "depth": "How many levels of reverse dependencies of the changed modules"
+        " to test as well. 0 disables them, negative means all. Default: -1",
     }
 )
-def test_changed(c, base=None, coverage=False):
+def test_changed(c, base=None, coverage=False, depth=-1):
     """
-    Automatically run unit tests for changed modules.
+    Automatically run unit tests for changed modules, and the modules
+    depending on them.
     """
     private_path = SRC_PATH / "private"
-    import subprocess
-
     if not base:
         base = "origin/HEAD"
 
@@ -815,26 +3291,26 @@ def test_changed(c, base=None, coverage=False):
         .split("\n")
     )
 
+    # Map every changed file to the addon containing it
     todo = set(
-        map(
-            # Extract just the directory name from our against_path
-            # These should just be Odoo modules by default
-            lambda p: Path(p).parts[4:5][0],
-            filter(
-                # Remove False-y values and only directories within our against
-                # path
-                lambda p: p and os.path.isdir(os.path.join(*Path(p).parts[0:5])),
-                git_output,
-            ),
-        )
+        filter(None, (_get_path_addon(PROJECT_ROOT / p) for p in git_output if p))
     )
 
     if not todo:
         _logger.info("No changed modules found")
         return
 
+    dependants = _reverse_dependencies(todo, depth) if depth else {}
+    msg = ["Test plan against {}:".format(base)]
+    for addon in sorted(todo):
+        msg.append("  {} (changed)".format(addon))
+    for addon, (level, via) in sorted(dependants.items(), key=lambda i: i[1]):
+        msg.append("  {} (depends on {}, depth {})".format(addon, via, level))
+    _logger.info("\n".join(msg))
+    todo.update(dependants)
+
     _logger.info("Running tests for modules: %s", todo)
-    return test(c, modules=",".join(todo), coverage=coverage)
+    return test(c, modules=",".join(sorted(todo)), coverage=coverage)
 
 
 @task
@@ -0,0 +1,161 @@
+import json
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("click")
+pytest.importorskip("jinja2")
+requests = pytest.importorskip("requests")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tools"))
+import copier_update  # noqa: E402
+
+REPO = copier_update.RepositoryRef(org="org", repo="repo", branch="16.0")
+
+
+class StubGitHub(BaseHTTPRequestHandler):
+    """Answer each request with the next response queued for its path."""
+
+    def log_message(self, *args):
+        pass
+
+    def _answer(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        path = self.path.split("?")[0]
+        self.server.calls.append((self.command, path, dict(self.headers), body))
+        status, headers, payload = self.server.responses[path].pop(0)
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = _answer
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubGitHub)
+    httpd.calls, httpd.responses = [], {}
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(
+        target=httpd.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(copier_update.GitHubClient, "WRITE_INTERVAL", 0)
+    return copier_update.GitHubClient(
+        "token", base_url=server.url, cache_dir=str(tmp_path / "http")
+    )
+
+
+def test_conditional_get_reuses_cached_body(server, client):
+    path = "/repos/org/repo/contents/.copier-answers.yml"
+    server.responses[path] = [
+        (200, {"ETag": '"v1"'}, b"_commit: v1\n"),
+        (304, {"ETag": '"v1"'}, b""),
+    ]
+    assert client.read_file(REPO, ".copier-answers.yml") == "_commit: v1\n"
+    assert client.read_file(REPO, ".copier-answers.yml") == "_commit: v1\n"
+    assert "If-None-Match" not in server.calls[0][2]
+    assert server.calls[1][2]["If-None-Match"] == '"v1"'
+
+
+def test_cached_bodies_are_not_shared_between_tokens(server, client, tmp_path):
+    path = "/repos/org/repo/contents/.copier-answers.yml"
+    server.responses[path] = [
+        (200, {"ETag": '"v1"'}, b"_commit: v1\n"),
+        (404, {}, {"message": "Not Found"}),
+    ]
+    assert client.read_file(REPO, ".copier-answers.yml") == "_commit: v1\n"
+    other = copier_update.GitHubClient(
+        "other", base_url=server.url, cache_dir=str(tmp_path / "http")
+    )
+    assert other.read_file(REPO, ".copier-answers.yml") is None
+    assert "If-None-Match" not in server.calls[1][2]
+
+
+def test_retries_after_rate_limit(server, client):
+    path = "/repos/org/repo/pulls"
+    server.responses[path] = [
+        (429, {"Retry-After": "0"}, {"message": "secondary rate limit"}),
+        (200, {}, [{"number": 7, "html_url": "https://github.com/org/repo/pull/7"}]),
+    ]
+    assert client.find_pull_request(REPO, "16.0-copier") == {
+        "number": 7,
+        "url": "https://github.com/org/repo/pull/7",
+    }
+    assert len(server.calls) == 2
+
+
+def test_failed_write_raises(server, client):
+    server.responses["/repos/org/repo/pulls/7"] = [
+        (422, {}, {"message": "Validation Failed"})
+    ]
+    with pytest.raises(requests.HTTPError, match="422"):
+        client.create_or_update_pull_request(
+            REPO, "16.0-copier", "title", "body", existing={"number": 7}
+        )
+
+
+@pytest.mark.parametrize(
+    "prefix, graphql_path",
+    [("", "/graphql"), ("/api/v3", "/api/graphql")],
+)
+def test_graphql_endpoint_follows_api_url(server, prefix, graphql_path):
+    client = copier_update.GitHubClient("token", base_url=server.url + prefix)
+    other = copier_update.RepositoryRef(org="org", repo="other", branch="15.0")
+    pull = {"number": 3, "url": "https://github.com/org/repo/pull/3"}
+    server.responses[graphql_path] = [
+        (
+            200,
+            {},
+            {
+                "data": {
+                    "r0": {"pullRequests": {"nodes": [pull]}},
+                    "r1": {"pullRequests": {"nodes": []}},
+                }
+            },
+        )
+    ]
+    found = client.find_pull_requests(
+        [REPO, other], lambda repo: f"{repo.branch}-copier"
+    )
+    assert found == {REPO: pull, other: None}
+    method, path, headers, body = server.calls[0]
+    assert (method, path) == ("POST", graphql_path)
+    assert headers["Authorization"] == "Bearer token"
+    assert 'headRefName: "15.0-copier"' in json.loads(body)["query"]
+
+
+def test_latest_template_version_skips_prereleases(tmp_path):
+    def git(*args):
+        subprocess.run(["git", "-C", str(tmp_path), *args], check=True)
+
+    git("init", "-q")
+    git(
+        "-c",
+        "user.name=t",
+        "-c",
+        "user.email=t@t",
+        "commit",
+        "-q",
+        "--allow-empty",
+        "-m",
+        "t",
+    )
+    for tag in ("v1.9.0", "v1.10.0", "v2.0.0a1", "latest"):
+        git("tag", tag)
+    assert copier_update._latest_template_version(str(tmp_path)) == "v1.10.0"
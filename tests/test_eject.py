@@ -0,0 +1,94 @@
+import importlib.util
+import sys
+import types
+import zipfile
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+EJECT = Path(__file__).resolve().parent.parent / "src/odoo/custom/hack/eject.py"
+
+
+class FakeCursor:
+    def __init__(self, modules, dependencies):
+        self.results = [modules, dependencies]
+
+    def execute(self, query, params):
+        self.rows = self.results.pop(0)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def eject(monkeypatch, tmp_path):
+    """Load eject.py against a minimal fake `odoo` package."""
+    connected = []
+    cursor = FakeCursor(
+        [(1, "a", "https://example.com", "LGPL-3", "Me")], [(1, "base")]
+    )
+    modules = {
+        "odoo": types.ModuleType("odoo"),
+        "odoo.api": types.SimpleNamespace(Environment=object),
+        "odoo.cli": types.ModuleType("odoo.cli"),
+        "odoo.cli.server": types.SimpleNamespace(report_configuration=lambda: None),
+        "odoo.modules": types.ModuleType("odoo.modules"),
+        "odoo.modules.registry": types.ModuleType("odoo.modules.registry"),
+    }
+    odoo = modules["odoo"]
+    odoo.release = types.SimpleNamespace(version="17.0", version_info=(17, 0))
+    config = type("Config", (dict,), {"parse_config": lambda self, args, **kw: None})
+    odoo.tools = types.SimpleNamespace(config=config(db_name=None))
+    odoo.sql_db = types.SimpleNamespace(
+        db_connect=lambda database: connected.append(database)
+        or types.SimpleNamespace(cursor=lambda: cursor)
+    )
+    modules["odoo.release"] = odoo.release
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    for name in [m for m in sys.modules if m.split(".")[0] == "click_odoo"]:
+        monkeypatch.delitem(sys.modules, name)
+    pytest.importorskip("click_odoo")
+    pytest.importorskip("manifestoo_core")
+
+    spec = importlib.util.spec_from_file_location("eject", EJECT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    addons = tmp_path / "addons"
+    (addons / "a").mkdir(parents=True)
+    (addons / "a" / "__manifest__.py").write_text("{'name': 'A'}")
+    (tmp_path / "odoo.conf").write_text("[options]\n")
+    monkeypatch.setattr(module, "ADDONS_PATH", str(addons))
+    monkeypatch.setattr(module, "PRIVATE_PATH", str(tmp_path / "private"))
+    monkeypatch.setattr(module, "ODOO_CONF", str(tmp_path / "odoo.conf"))
+    module.connected = connected
+    return module
+
+
+def test_export_and_verify(eject, tmp_path):
+    path = tmp_path / "export.zip"
+    runner = CliRunner()
+    result = runner.invoke(eject.main, ["-d", "devel", "--path", str(path)])
+    assert result.exit_code == 0, result.output
+    assert eject.connected == ["devel"]
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+    assert names[0] == eject.MANIFEST
+    assert {"addons/a/__manifest__.py", "addons.csv", "odoo.conf"} <= set(names)
+
+    result = runner.invoke(eject.main, ["--verify", str(path)])
+    assert result.exit_code == 0, result.output
+
+
+def test_missing_addon_fails(eject, tmp_path):
+    (tmp_path / "addons" / "a" / "__manifest__.py").unlink()
+    (tmp_path / "addons" / "a").rmdir()
+    path = tmp_path / "export.zip"
+    result = CliRunner().invoke(eject.main, ["-d", "devel", "--path", str(path)])
+    assert result.exit_code != 0
+    assert "a is installed, but not found" in result.output
+    assert not path.exists()
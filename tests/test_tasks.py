@@ -0,0 +1,233 @@
+import importlib.util
+import logging
+import shutil
+from pathlib import Path
+
+import pytest
+
+yaml = pytest.importorskip("invoke.util").yaml
+
+TASKS = Path(__file__).resolve().parent.parent / "src/tasks_downstream.py"
+
+
+def _addon(src, path, depends=(), installable=True):
+    addon = src / path
+    addon.mkdir(parents=True)
+    (addon / "__manifest__.py").write_text(
+        repr({"depends": list(depends), "installable": installable})
+    )
+    return addon
+
+
+@pytest.fixture
+def tasks(tmp_path):
+    """Load the tasks file from a minimal project in `tmp_path`."""
+    shutil.copy(str(TASKS), str(tmp_path / "tasks.py"))
+    (tmp_path / "devel.yaml").write_text(
+        yaml.safe_dump(
+            {
+                "services": {
+                    "odoo": {
+                        "build": {"args": {"ODOO_VERSION": "17.0"}},
+                        "environment": {"PGDATABASE": "devel", "PGUSER": "odoo"},
+                    }
+                }
+            }
+        )
+    )
+    src = tmp_path / "odoo" / "custom" / "src"
+    _addon(src, "odoo/addons/base")
+    _addon(src, "private/sale_extra", depends=["base"])
+    _addon(src, "private/sale_report", depends=["sale_extra"])
+    _addon(src, "private/broken", depends=["base"], installable=False)
+    _addon(src, "oca/stock_extra", depends=["sale_extra"])
+    (src / "addons.yaml").write_text("oca:\n  - stock_*\n")
+    spec = importlib.util.spec_from_file_location("tasks", tmp_path / "tasks.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_resolve_addons(tasks):
+    assert tasks._resolve_addons(private=True) == ["sale_extra", "sale_report"]
+    assert tasks._resolve_addons(extra=True) == ["stock_extra"]
+    assert tasks._resolve_addons(core=True, modules="broken") == ["base"]
+    assert tasks._resolve_addons(private=True, only_installable=False) == [
+        "broken",
+        "sale_extra",
+        "sale_report",
+    ]
+
+
+def test_resolve_addons_warns_on_unmatched_glob(tasks, caplog):
+    (tasks.SRC_PATH / "addons.yaml").write_text("oca:\n  - stock_*\n  - missing\n")
+    with caplog.at_level(logging.WARNING):
+        assert tasks._resolve_addons(extra=True) == ["stock_extra"]
+    assert "Glob missing in addons.yaml matches no addon in oca" in caplog.text
+
+
+def test_resolve_addons_needs_container_for_only_sections(tasks):
+    (tasks.SRC_PATH / "addons.yaml").write_text("ONLY:\n  PGDATABASE: [prod]\n")
+    assert tasks._resolve_addons(private=True) is None
+
+
+def test_get_cwd_addon(tasks, tmp_path):
+    addon = tasks.SRC_PATH / "private" / "sale_extra"
+    (addon / "models").mkdir()
+    assert tasks._get_cwd_addon(addon / "models") == "sale_extra"
+    assert tasks._get_cwd_addon(tasks.SRC_PATH / "private") is None
+    # Addons nested deeper than the index looks are still found
+    nested = _addon(tasks.SRC_PATH, "oca/setup/stock_extra/odoo/addons/stock_x")
+    assert tasks._get_cwd_addon(nested) == "stock_x"
+
+
+def test_test_template_key_follows_addon_files(tasks):
+    key = tasks._test_template_key(["base", "sale_extra"])
+    assert tasks._test_template_key(["base", "sale_extra"]) == key
+    views = tasks.SRC_PATH / "private" / "sale_extra" / "views.xml"
+    views.write_text("<odoo/>")
+    assert tasks._test_template_key(["base", "sale_extra"]) != key
+    key = tasks._test_template_key(["base", "sale_extra"])
+    # Bytecode written by Odoo doesn't count
+    (views.parent / "__pycache__").mkdir()
+    (views.parent / "__pycache__" / "models.cpython-310.pyc").write_bytes(b"")
+    assert tasks._test_template_key(["base", "sale_extra"]) == key
+
+
+def _log(second, logger, message, pid=10):
+    return f"2024-05-01 10:00:{second:02d},000 {pid} INFO devel {logger}: {message}\n"
+
+
+def test_parse_test_log(tasks):
+    tests = tasks._parse_test_log(
+        [
+            _log(0, "odoo.addons.sale.tests.test_a", "Starting TestA.test_one ..."),
+            _log(2, "odoo.addons.sale.tests.test_a", "Starting TestA.test_two ..."),
+            _log(3, "odoo.addons.sale.tests.test_a", "FAIL: TestA.test_two"),
+            _log(5, "odoo.modules.loading", "module stock: loading stock_data.xml"),
+            _log(9, "odoo.addons.stock.tests.test_b", "Starting TestB.test_sub ..."),
+            _log(
+                10,
+                "odoo.addons.stock.tests.test_b",
+                "ERROR: test_sub (odoo.addons.stock.tests.test_b.TestB) [line 2]",
+            ),
+            _log(11, "odoo.addons.stock.tests.test_b", "Starting TestB.test_new ..."),
+            _log(
+                12,
+                "odoo.addons.stock.tests.test_b",
+                "FAIL: test_new (odoo.addons.stock.tests.test_b.TestB.test_new) (i=1)",
+            ),
+            _log(14, "odoo.service.server", "Starting post tests"),
+            _log(20, "odoo.service.server", "Initiating shutdown"),
+        ]
+    )
+    assert [
+        (t["module"], t["class"], t["method"], t["status"], t["duration"])
+        for t in tests
+    ] == [
+        ("sale", "TestA", "test_one", "ok", 2),
+        ("sale", "TestA", "test_two", "fail", 3),
+        ("stock", "TestB", "test_sub", "error", 2),
+        ("stock", "TestB", "test_new", "fail", 3),
+    ]
+
+
+def test_parse_test_log_processes(tasks):
+    tests = tasks._parse_test_log(
+        [
+            _log(0, "odoo.addons.a.tests.t", "Starting T.test_a ...", pid=1),
+            _log(1, "odoo.addons.b.tests.t", "Starting T.test_b ...", pid=2),
+            "not an odoo log line\n",
+            _log(4, "odoo.addons.b.tests.t", "Starting T.test_c ...", pid=2),
+            _log(6, "odoo.modules.registry", "Registry loaded", pid=1),
+        ]
+    )
+    assert [(t["method"], t["duration"]) for t in tests] == [
+        ("test_a", 6),
+        ("test_b", 3),
+        ("test_c", 2),
+    ]
+
+
+def test_test_isolated_without_modules(tasks, caplog):
+    from invoke import Context
+
+    assert tasks._test_isolated(Context(), [""], "init", False, shards=2) is None
+    assert "No modules to test" in caplog.text
+
+
+def test_reverse_dependencies(tasks):
+    assert tasks._reverse_dependencies(["base"]) == {
+        "sale_extra": (1, "base"),
+        "sale_report": (2, "sale_extra"),
+        "stock_extra": (2, "sale_extra"),
+    }
+    assert tasks._reverse_dependencies(["base"], depth=1) == {
+        "sale_extra": (1, "base"),
+    }
+    # Addons disabled in addons.yaml are left out
+    (tasks.SRC_PATH / "addons.yaml").write_text("oca: []\n")
+    assert tasks._reverse_dependencies(["sale_extra"]) == {
+        "sale_report": (1, "sale_extra")
+    }
+
+
+def test_compose_changes(tasks):
+    container = tasks.ComposeContainer
+    before = {
+        "db": container("1", "db", "running"),
+        "odoo": container("2", "odoo", "exited"),
+        "proxy": container("3", "proxy", "running"),
+    }
+    after = {
+        "db": container("1", "db", "running"),
+        "odoo": container("2", "odoo", "running"),
+        "proxy": container("4", "proxy", "running"),
+        "mail": container("5", "mail", "created"),
+    }
+    assert tasks._compose_changes(before, after) == {"odoo", "proxy", "mail"}
+    assert tasks._compose_changes(after, after) == set()
+
+
+def _request(path, queries, sql_time, python_time, method="GET"):
+    return (
+        f'2024-05-01 10:00:00,000 10 INFO devel werkzeug: 127.0.0.1 - - "{method} '
+        f'{path} HTTP/1.1" 200 - {queries} {sql_time} {python_time}\n'
+    )
+
+
+def test_request_stats(tasks, capsys):
+    stats = tasks._RequestStats(window=2)
+    stats.write(_request("/web/content/42?download=1", 3, 0.5, 0.5))
+    # Lines can be split across writes
+    line = _request("/web/content/43", 5, 0.25, 0.5)
+    stats.write(line[:30])
+    stats.write(line[30:] + _request("/web/dataset/call_kw", 80, 0.125, 0.125))
+    stats.write(_request("/web/content/44", 1, 0.0625, 0.0625))
+    stats.write("\x1b[1;32mnot a request\x1b[0m\n")
+    assert stats.routes == {
+        "GET /web/content/<id>": [(0.75, 5, 0.25), (0.125, 1, 0.0625)],
+        "GET /web/dataset/call_kw": [(0.25, 80, 0.125)],
+    }
+    assert stats.n_plus_one == {"GET /web/dataset/call_kw": 1}
+    stats.print_table()
+    rows = capsys.readouterr().out.splitlines()
+    assert rows[0].startswith("route")
+    assert rows[1].split()[:3] == ["GET", "/web/content/<id>", "2"]
+    assert rows[2].split()[:3] == ["GET", "/web/dataset/call_kw", "1"]
+    assert rows[2].split()[-1] == "1"
+
+
+def test_base_images(tasks):
+    (tasks.PROJECT_ROOT / "odoo" / "Dockerfile").write_text(
+        "ARG ODOO_VERSION\n"
+        "ARG REGISTRY=ghcr.io\n"
+        "FROM --platform=linux/amd64 $REGISTRY/tools:1 AS tools\n"
+        "FROM ${REGISTRY}/tecnativa/doodba:${ODOO_VERSION}-onbuild\n"
+        "COPY --from=tools /bin/tool /bin/tool\n"
+        "FROM tools\n"
+    )
+    assert tasks._base_images() == [
+        "ghcr.io/tools:1",
+        "ghcr.io/tecnativa/doodba:17.0-onbuild",
+    ]
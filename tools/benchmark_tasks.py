@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Benchmark the orchestration overhead of the invoke tasks.
+
+Builds a synthetic project around `src/tasks_downstream.py`, puts stub `docker`,
+`git`, `gitaggregate` and `pre-commit` executables first on `PATH`, times the
+host-side work of the tasks and appends the results to a JSON lines file, so
+runs can be compared over time.
+"""
+
+import datetime
+import importlib.util
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import click
+import yaml
+from invoke import Context
+
+logging.basicConfig()
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+FAKE_SHA = "0" * 40
+STUBS = {
+    "docker": """#!/bin/sh
+case "$*" in
+    *" ps "*) echo "[]" ;;
+esac
+exit 0
+""",
+    "git": """#!/bin/sh
+case "$*" in
+    *diff-index*) cat "$BENCHMARK_CHANGED_FILES" ;;
+    *rev-parse*) echo %(sha)s ;;
+    *ls-remote*) echo "%(sha)s	refs/heads/$4" ;;
+esac
+exit 0
+"""
+    % {"sha": FAKE_SHA},
+    "gitaggregate": "#!/bin/sh\nexit 0\n",
+    "pre-commit": "#!/bin/sh\nexit 0\n",
+}
+
+
+def _write_stubs(bin_path):
+    bin_path.mkdir()
+    for name, content in STUBS.items():
+        stub = bin_path / name
+        stub.write_text(content)
+        stub.chmod(0o755)
+
+
+def _write_addon(path, depends):
+    path.mkdir(parents=True)
+    (path / "__init__.py").write_text("")
+    (path / "models").mkdir()
+    (path / "models" / "__init__.py").write_text("")
+    (path / "__manifest__.py").write_text(
+        repr(
+            {
+                "name": path.name,
+                "version": "17.0.1.0.0",
+                "depends": depends,
+                "installable": True,
+            }
+        )
+    )
+
+
+def _make_project(root, addons, repos, seed):
+    """Create a project with `addons` addons spread over `repos` repositories.
+
+    Addons only depend on addons created before them, so the dependency graph
+    is acyclic, and a few of them are core addons like in real projects.
+    """
+    rng = random.Random(seed)
+    shutil.copy(str(REPO_ROOT / "src" / "tasks_downstream.py"), str(root / "tasks.py"))
+    (root / "devel.yaml").write_text(
+        yaml.safe_dump(
+            {
+                "services": {
+                    "odoo": {
+                        "build": {"args": {"ODOO_VERSION": "17.0"}},
+                        "environment": {"PGDATABASE": "devel", "PGUSER": "odoo"},
+                        "command": ["odoo", "--workers=0"],
+                    }
+                }
+            }
+        )
+    )
+    (root / "odoo" / "custom" / "ssh").mkdir(parents=True)
+    (root / "odoo" / "custom" / "ssh" / "config").write_text("")
+    src = root / "odoo" / "custom" / "src"
+    containers = ["odoo/addons", "private"] + [f"repo{i}" for i in range(repos)]
+    names = []
+    for i in range(addons):
+        # Core gets a fifth of the addons, private a tenth
+        if i < addons // 5:
+            container = containers[0]
+        elif i < addons * 3 // 10:
+            container = containers[1]
+        else:
+            container = rng.choice(containers[2:] or containers[:2])
+        name = f"addon_{i:05d}"
+        depends = sorted(set(rng.sample(names, min(len(names), rng.randint(0, 4)))))
+        _write_addon(src / container / name, depends or ["base"])
+        names.append(name)
+    (src / "repos.yaml").write_text(
+        yaml.safe_dump(
+            {
+                f"./{repo}": {
+                    "defaults": {"depth": "$DEPTH_DEFAULT"},
+                    "remotes": {"origin": f"https://github.com/bench/{repo}.git"},
+                    "target": "origin $ODOO_VERSION",
+                    "merges": ["origin $ODOO_VERSION"],
+                }
+                for repo in ["odoo"] + containers[2:]
+            }
+        )
+    )
+    (src / "addons.yaml").write_text(
+        yaml.safe_dump({repo: ["*"] for repo in containers[2:]})
+    )
+    private = sorted((src / "private").iterdir())
+    changed = rng.sample(private, min(20, len(private)))
+    (root / "changed.txt").write_text(
+        "".join(
+            f"{(p / 'models' / '__init__.py').relative_to(root)}\n" for p in changed
+        )
+    )
+    return private[-1] / "models"
+
+
+def _load_tasks(root):
+    spec = importlib.util.spec_from_file_location("benchmark_tasks", root / "tasks.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _benchmarks(module, cwd_path):
+    """Return `(setup, run)` pairs to time, keyed by benchmark name."""
+    context = Context()
+    yaml_files = {
+        path: path.read_text()
+        for path in (module.SRC_PATH / "repos.yaml", module.SRC_PATH / "addons.yaml")
+    }
+
+    def cold_cache():
+        module._addons_index_cache = None
+        if module.ADDONS_INDEX_FILE.exists():
+            module.ADDONS_INDEX_FILE.unlink()
+
+    def warm_cache():
+        module._addons_index_cache = None
+        module._addons_index()
+        module._addons_index_cache = None
+
+    def restore_yaml():
+        for path, content in yaml_files.items():
+            path.write_text(content)
+
+    def test_changed():
+        with redirect_stdout(io.StringIO()):
+            module.test_changed(context, base="HEAD")
+
+    # Only measure the planning, not the tests
+    module.test = lambda c, **kwargs: None
+    return {
+        "addons_index_cold": (cold_cache, module._addons_index),
+        "addons_index_warm": (warm_cache, module._addons_index),
+        "module_list": (
+            warm_cache,
+            lambda: module._get_module_list(context, private=True, extra=True),
+        ),
+        "cwd_addon": (warm_cache, lambda: module._get_cwd_addon(cwd_path)),
+        "test_changed_plan": (warm_cache, test_changed),
+        "add_github_repository": (
+            restore_yaml,
+            lambda: module.add_github_repository(
+                context, organisation="oca", repository="benchmark"
+            ),
+        ),
+    }
+
+
+def _time(setup, run, repeat):
+    durations = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        run()
+        durations.append((time.perf_counter() - start) * 1000)
+    return {
+        "min_ms": min(durations),
+        "median_ms": statistics.median(durations),
+        "max_ms": max(durations),
+    }
+
+
+def _read_results(output):
+    try:
+        with open(output) as fd:
+            return [json.loads(line) for line in fd if line.strip()]
+    except OSError:
+        return []
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "-C", str(REPO_ROOT), "rev-parse", "HEAD"], text=True
+        ).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+@click.command()
+@click.option("--addons", default=3000, help="Number of addons in the project")
+@click.option("--repos", default=40, help="Number of aggregated repositories")
+@click.option("--repeat", default=5, help="Times to run each benchmark")
+@click.option("--seed", default=0, help="Seed of the synthetic project")
+@click.option(
+    "--only", multiple=True, help="Only run these benchmarks. Can be repeated"
+)
+@click.option(
+    "--output",
+    default=str(REPO_ROOT / ".benchmarks" / "tasks.jsonl"),
+    show_default=True,
+    help="File the results are appended to",
+)
+@click.option(
+    "--compare/--no-compare",
+    default=True,
+    help="Compare with the previous run with the same parameters",
+)
+def main(addons, repos, repeat, seed, only, output, compare):
+    params = {"addons": addons, "repos": repos, "repeat": repeat, "seed": seed}
+    previous = [r for r in _read_results(output) if r["params"] == params]
+    record = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": {},
+    }
+    old_environ = dict(os.environ)
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        _logger.info("Creating a project with %d addons in %d repos", addons, repos)
+        cwd_path = _make_project(root, addons, repos, seed)
+        _write_stubs(root / "bin")
+        os.environ["PATH"] = f"{root / 'bin'}{os.pathsep}{os.environ['PATH']}"
+        os.environ["BENCHMARK_CHANGED_FILES"] = str(root / "changed.txt")
+        os.chdir(str(root))
+        try:
+            module = _load_tasks(root)
+            for name, (setup, run) in _benchmarks(module, cwd_path).items():
+                if only and name not in only:
+                    continue
+                record["results"][name] = _time(setup, run, repeat)
+        finally:
+            os.chdir(old_cwd)
+            os.environ.clear()
+            os.environ.update(old_environ)
+
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "a") as fd:
+        fd.write(json.dumps(record, sort_keys=True) + "\n")
+
+    baseline = previous[-1]["results"] if compare and previous else {}
+    click.echo(f"{'benchmark':<24} {'median':>10} {'min':>10} {'previous':>10}")
+    for name, result in record["results"].items():
+        old = baseline.get(name)
+        change = (
+            f"{result['median_ms'] / old['median_ms']:>9.2f}x"
+            if old and old["median_ms"]
+            else f"{'-':>10}"
+        )
+        click.echo(
+            f"{name:<24} {result['median_ms']:>8.1f}ms {result['min_ms']:>8.1f}ms"
+            f" {change}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
 
 import datetime
+import fcntl
+import functools
+import hashlib
+import json
 import yaml
 import logging
 import os
 import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import click
 import typing
 import re
 from typing import NamedTuple
 import requests
+from packaging import version
+from requests.adapters import HTTPAdapter
 from jinja2 import Template
 
 
@@ -19,12 +28,91 @@ logging.basicConfig()
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
 RepositoryRef = NamedTuple("Repo", [("org", str), ("repo", str), ("branch", str)])
+_output_lock = threading.Lock()
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "odoo-scaffolding", "copier-update"
+)
+
+
+class CommandError(Exception):
+    pass
+
+
+def _label(repo: RepositoryRef) -> str:
+    return f"{repo.org}/{repo.repo}#{repo.branch}"
+
+
+def _run(cmd: list[str], cwd: str, prefix: str, check: bool = True) -> int:
+    """
+    run cmd in cwd, printing each line of its output after prefix
+    """
+    process = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    for line in process.stdout:
+        with _output_lock:
+            click.echo(f"[{prefix}] {line.rstrip()}")
+    returncode = process.wait()
+    if check and returncode != 0:
+        raise CommandError(f"{' '.join(cmd)} exited with {returncode}")
+    return returncode
+
+
+@contextmanager
+def _mirror_lock(mirror: str):
+    """
+    hold an exclusive lock on mirror, shared with other workers and runs
+    """
+    with open(f"{mirror}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _update_mirror(repo: RepositoryRef, repo_url: str, cache_dir: str) -> str:
+    """
+    fetch the branch of repo into its bare mirror in cache_dir and return the
+    mirror path, only new objects are downloaded after the first run
+    """
+    mirror = os.path.join(cache_dir, repo.org, f"{repo.repo}.git")
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    with _mirror_lock(mirror):
+        if not os.path.isdir(mirror):
+            _run(["git", "init", "-q", "--bare", mirror], cache_dir, _label(repo))
+            # Clones borrow objects from the mirror, they must never be pruned
+            _run(["git", "config", "gc.auto", "0"], mirror, _label(repo))
+            _run(["git", "remote", "add", "origin", repo_url], mirror, _label(repo))
+        _run(
+            [
+                "git",
+                "fetch",
+                "--quiet",
+                "--no-tags",
+                "origin",
+                f"+refs/heads/{repo.branch}:refs/heads/{repo.branch}",
+            ],
+            mirror,
+            _label(repo),
+        )
+    return mirror
 
 
 @contextmanager
-def with_temporary_clone(repo: RepositoryRef):
+def with_temporary_clone(repo: RepositoryRef, cache_dir: str | None = None):
     """
-    context manager that clones a git branch and cd to it
+    context manager that clones a git branch into a temporary directory and
+    yields its path
+
+    With a cache_dir, objects are borrowed from a persistent bare mirror of
+    the repository, otherwise the clone is blobless.
     """
     repo_url = f"git@github.com:{repo.org}/{repo.repo}.git"
 
@@ -32,19 +120,245 @@ def with_temporary_clone(repo: RepositoryRef):
         clone_cmd = [
             "git",
             "clone",
+            "--single-branch",
+            "--no-tags",
             "--branch",
             repo.branch,
-            "--",
-            repo_url,
-            temp_dir,
         ]
-        subprocess.check_call(clone_cmd)
-        cwd = os.getcwd()
-        os.chdir(temp_dir)
-        try:
-            yield
-        finally:
-            os.chdir(cwd)
+        if cache_dir:
+            mirror = _update_mirror(repo, repo_url, cache_dir)
+            clone_cmd.extend(["--reference", mirror])
+        else:
+            clone_cmd.append("--filter=blob:none")
+        clone_cmd.extend(["--", repo_url, temp_dir])
+        _run(clone_cmd, cwd=temp_dir, prefix=_label(repo))
+        yield temp_dir
+
+
+class GitHubClient:
+    """
+    GitHub API client shared by all workers
+
+    Connections are pooled, GETs are conditional on the ETag of the previous
+    response, which GitHub does not count against the rate limit, rate
+    limited requests are retried after the delay GitHub asks for, and writes
+    are spaced out as recommended to avoid the secondary rate limits.
+    """
+
+    WRITE_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        token: str,
+        base_url: str = "https://api.github.com",
+        cache_dir: str | None = None,
+        pool_size: int = 10,
+        max_retries: int = 5,
+    ):
+        self.base_url = base_url.rstrip("/")
+        # GitHub Enterprise serves GraphQL on /api/graphql, beside /api/v3
+        self.graphql_url = re.sub(r"/v3$", "", self.base_url) + "/graphql"
+        self.cache_dir = cache_dir
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {
+                "Accept": "application/vnd.github+json",
+                "Authorization": f"Bearer {token}",
+                "X-GitHub-Api-Version": "2022-11-28",
+            }
+        )
+        # Responses depend on what the token can see, so tokens don't share them
+        self._token_hash = hashlib.sha256(token.encode()).hexdigest()
+        self._write_lock = threading.Lock()
+        self._last_write = 0.0
+
+    def _retry_delay(self, response: requests.Response, attempt: int) -> float | None:
+        """
+        return how long to wait before retrying response, or None
+        """
+        if response.status_code in (403, 429):
+            if "Retry-After" in response.headers:
+                return float(response.headers["Retry-After"])
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                reset = float(response.headers.get("X-RateLimit-Reset", 0))
+                return max(reset - time.time(), 0) + 1
+            if "rate limit" in response.text.lower():
+                return 60.0 * 2**attempt
+        elif response.status_code in (502, 503, 504):
+            return 2.0**attempt
+        return None
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        url = path if "://" in path else f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            if method != "GET":
+                with self._write_lock:
+                    time.sleep(
+                        max(
+                            self._last_write + self.WRITE_INTERVAL - time.monotonic(), 0
+                        )
+                    )
+                    self._last_write = time.monotonic()
+            response = self.session.request(method, url, **kwargs)
+            delay = self._retry_delay(response, attempt)
+            if delay is None or attempt == self.max_retries:
+                return response
+            _logger.warning(
+                "GitHub answered %s to %s %s, retrying in %.0fs",
+                response.status_code,
+                method,
+                url,
+                delay,
+            )
+            time.sleep(delay)
+        return response
+
+    def _cache_path(self, *key) -> str | None:
+        if not self.cache_dir:
+            return None
+        digest = hashlib.sha1(json.dumps([self._token_hash, *key]).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def get(
+        self, path: str, params: dict | None = None, accept: str | None = None
+    ) -> tuple[int, str]:
+        """
+        conditional GET of path, returning its status code and body
+        """
+        headers = {"Accept": accept} if accept else {}
+        cache_path = self._cache_path(self.base_url, path, params, accept)
+        cached = None
+        if cache_path:
+            try:
+                with open(cache_path) as f:
+                    cached = json.load(f)
+                headers["If-None-Match"] = cached["etag"]
+            except (OSError, ValueError, KeyError):
+                cached = None
+        response = self.request("GET", path, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached["status"], cached["body"]
+        if cache_path and response.headers.get("ETag") and response.status_code < 500:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{cache_path}.{threading.get_ident()}"
+            with open(temp_path, "w") as f:
+                json.dump(
+                    {
+                        "etag": response.headers["ETag"],
+                        "status": response.status_code,
+                        "body": response.text,
+                    },
+                    f,
+                )
+            os.replace(temp_path, cache_path)
+        return response.status_code, response.text
+
+    def read_file(self, repo: RepositoryRef, path: str) -> str | None:
+        """
+        return the content of path in the branch of repo, or None if missing
+        """
+        status, body = self.get(
+            f"/repos/{repo.org}/{repo.repo}/contents/{path}",
+            params={"ref": repo.branch},
+            accept="application/vnd.github.raw+json",
+        )
+        if status == 404:
+            return None
+        if status >= 400:
+            raise requests.HTTPError(
+                f"{status} reading {path} of {_label(repo)}: {body}"
+            )
+        return body
+
+    def find_pull_request(self, repo: RepositoryRef, head: str) -> dict | None:
+        """
+        return the number and url of the open pull request of head into the
+        branch of repo, if any
+        """
+        status, body = self.get(
+            f"/repos/{repo.org}/{repo.repo}/pulls",
+            params={
+                "state": "open",
+                "head": f"{repo.org}:{head}",
+                "base": repo.branch,
+            },
+        )
+        if status >= 400:
+            raise requests.HTTPError(
+                f"{status} listing pulls of {_label(repo)}: {body}"
+            )
+        existing = next(iter(json.loads(body)), None)
+        return existing and {"number": existing["number"], "url": existing["html_url"]}
+
+    def find_pull_requests(
+        self, repos: typing.Iterable[RepositoryRef], head: typing.Callable
+    ) -> dict:
+        """
+        look up the open pull requests of head(repo) into every repo with a
+        single GraphQL query, returning them by repo like find_pull_request
+        """
+        repos = list(repos)
+        fields = "\n".join(
+            f"r{i}: repository(owner: {json.dumps(repo.org)}, name: {json.dumps(repo.repo)}) {{"
+            f" pullRequests(states: OPEN, first: 1, headRefName: {json.dumps(head(repo))},"
+            f" baseRefName: {json.dumps(repo.branch)}) {{ nodes {{ number url }} }} }}"
+            for i, repo in enumerate(repos)
+        )
+        response = self.request(
+            "POST", self.graphql_url, json={"query": f"query {{\n{fields}\n}}"}
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data.get("errors"):
+            raise requests.HTTPError(f"GraphQL errors: {data['errors']}")
+        return {
+            repo: next(iter(data["data"][f"r{i}"]["pullRequests"]["nodes"]), None)
+            for i, repo in enumerate(repos)
+        }
+
+    def create_or_update_pull_request(
+        self,
+        repo: RepositoryRef,
+        head: str,
+        title: str,
+        body: str,
+        existing: dict | None | bool = False,
+    ) -> str:
+        """
+        create the pull request of head into the branch of repo, or update the
+        open one, and return its url
+
+        existing is the result of a previous lookup, False to look it up.
+        """
+        if existing is False:
+            existing = self.find_pull_request(repo, head)
+        payload = {
+            "title": title,
+            "body": body,
+            "head": f"{repo.org}:{head}",
+            "base": repo.branch,
+        }
+        if existing:
+            response = self.request(
+                "PATCH",
+                f"/repos/{repo.org}/{repo.repo}/pulls/{existing['number']}",
+                json=payload,
+            )
+        else:
+            response = self.request(
+                "POST", f"/repos/{repo.org}/{repo.repo}/pulls", json=payload
+            )
+        if not response.ok:
+            raise requests.HTTPError(
+                f"{response.status_code} saving the pull request of {_label(repo)}:"
+                f" {response.text}",
+                response=response,
+            )
+        return response.json()["html_url"]
 
 
 def _extract_repository_refs(ctx, param, value):
@@ -65,65 +379,169 @@ def _extract_repository_refs(ctx, param, value):
     return res
 
 
+@functools.lru_cache(maxsize=None)
+def _latest_template_version(src_path: str) -> str | None:
+    """
+    return the newest tag of the template at src_path, the one copier update
+    moves to by default, or None if it cannot be found
+    """
+    url = re.sub(r"^gh:", "https://github.com/", src_path)
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-remote", "--tags", "--refs", url],
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        _logger.warning("Could not list the tags of %s", src_path)
+        return None
+    # Like copier: PEP 440 versions, without pre-releases
+    versions = {}
+    for line in output.splitlines():
+        tag = line.split("refs/tags/", 1)[1]
+        try:
+            parsed = version.parse(tag)
+        except version.InvalidVersion:
+            continue
+        if not parsed.is_prerelease:
+            versions[parsed] = tag
+    return versions[max(versions)] if versions else None
+
+
+def _preflight(
+    client: GitHubClient, repo: RepositoryRef, template_version: str | None
+) -> tuple[str, str] | None:
+    """
+    return the outcome of repo when it does not need to be cloned, or None
+    when it must be cloned and updated, including when it cannot be told
+    """
+    try:
+        content = client.read_file(repo, ".copier-answers.yml")
+    except requests.RequestException as e:
+        _logger.warning(f" - could not read the answers of {_label(repo)}: {e}")
+        return None
+    if content is None:
+        _logger.warning(
+            f" - skipping {_label(repo)} because it has no .copier-answers.yml"
+        )
+        return "skipped", "no .copier-answers.yml"
+    answers = yaml.safe_load(content) or {}
+    current = answers.get("_commit")
+    target = template_version
+    if not target and answers.get("_src_path"):
+        target = _latest_template_version(answers["_src_path"])
+    if current and current == target:
+        _logger.info(f" - skipping {_label(repo)}, already on {current}")
+        return "up to date", current
+    return None
+
+
 def _render_template(template_path: str, **kwargs) -> str:
     with open(template_path, "r", encoding="utf8") as tf:
         template = Template(tf.read())
         return template.render(**kwargs)
 
 
-def _create_or_update_github_pr(
-    token: str,
-    head: str,
+def _update_repository(
     current_repo: RepositoryRef,
-    title: str,
-    body: str,
-) -> str | None:
-    # Create the pull request
-    headers = {
-        "Accept": "application/vnd.github+json",
-        "Authorization": f"Bearer {token}",
-        "X-GitHub-Api-Version": "2022-11-28",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    payload = {
-        "title": title,
-        "body": body,
-        "head": f"{current_repo.org}:{head}",
-        "base": current_repo.branch,
-    }
-
-    existing_response = requests.get(
-        f"https://api.github.com/repos/{current_repo.org}/{current_repo.repo}/pulls?state=open&head={current_repo.org}:{head}&base={current_repo.branch}",
-        headers=headers,
-    )
+    client: GitHubClient,
+    pull_request_body_template: str,
+    cache_dir: str | None = None,
+    template_version: str | None = None,
+    existing_pull: dict | None | bool = False,
+) -> tuple[str, str]:
+    """
+    run the copier update of current_repo and return its outcome and details
+    """
+    label = _label(current_repo)
+    _logger.info("Working on %s", label)
 
-    if existing_response.ok:
-        existing = next(iter(existing_response.json()), {})
-        if existing.get("number"):
-            number = existing.get("number")
-            requests.patch(
-                f"https://api.github.com/repos/{current_repo.org}/{current_repo.repo}/pulls/{number}",
-                headers=headers,
-                json=payload,
+    copier_branch = f"{current_repo.branch}-copier"
+
+    with with_temporary_clone(current_repo, cache_dir) as path:
+        answers_path = os.path.join(path, ".copier-answers.yml")
+        if not os.path.exists(answers_path):
+            _logger.warning(
+                f" - skipping {label} because it has no .copier-answers.yml"
             )
-            return existing.get("html_url")
+            return "skipped", "no .copier-answers.yml"
+
+        with open(answers_path, "r") as answers:
+            answers = yaml.safe_load(answers.read())
+            copier_version_before = answers.get("_commit", "unknown")
+            copier_template_url = answers.get("_src_path", "unknown")
+
+        _run(["git", "checkout", "-B", copier_branch], path, label)
+
+        copier_cmd = ["copier", "update", "--defaults", "--trust"]
+        if template_version:
+            copier_cmd.extend(["--vcs-ref", template_version])
+        r = _run(copier_cmd, path, label, False)
+        if r != 0:
+            _logger.error(f" - copier update failed on {label}")
+            return "failed", "copier update failed"
+
+        is_clean = False
+
+        # 3 attempts for a clean run is ideal
+        for _ in range(3):
+            # make sure we've added any files which may have been modified
+            _run(["git", "add", "."], path, label)
+            r = _run(["pre-commit", "run", "-a"], path, label, False)
+            if r == 0:
+                is_clean = True
+                break
 
-    response = requests.post(
-        f"https://api.github.com/repos/{current_repo.org}/{current_repo.repo}/pulls",
-        headers=headers,
-        json=payload,
-    )
+        # Make sure we've definitely got everything
+        if not is_clean:
+            _run(["git", "add", "."], path, label)
 
-    if response.ok:
-        return response.json().get("html_url")
+        # Are there any differences?
+        r = _run(
+            ["git", "diff", "--cached", "--quiet", "--exit-code"], path, label, False
+        )
+        if r == 0:
+            # No, continue
+            _logger.warning(f" - skipping {label}, no changes pending")
+            return "skipped", "no changes pending"
 
-    _logger.warning(
-        f"Failed to create PR for {current_repo}: %s %s",
-        response.status_code,
-        response.text,
-    )
+        commit_cmd = [
+            "git",
+            "commit",
+            "-m",
+            "ci: copier update",
+        ]
+        if not is_clean:
+            commit_cmd.append("--no-verify")
 
-    return None
+        with open(answers_path, "r") as answers:
+            copier_version_after = yaml.safe_load(answers.read()).get(
+                "_commit", "unknown"
+            )
+
+        # Push to GitHub
+        _run(commit_cmd, path, label)
+        _run(["git", "push", "-f", "-u", "origin", copier_branch], path, label)
+
+        # Create pull request
+        pull_url = client.create_or_update_pull_request(
+            current_repo,
+            copier_branch,
+            title=f"ci: copier template update {copier_version_before} to {copier_version_after}",
+            body=_render_template(
+                pull_request_body_template,
+                copier_template_url=copier_template_url,
+                copier_version_before=copier_version_before,
+                copier_version_after=copier_version_after,
+                is_clean=is_clean,
+                now=datetime.datetime.now(),
+                current_repo=current_repo,
+            ),
+            existing=existing_pull,
+        )
+
+        _logger.info(f"Created/Updated PR for {label} - {pull_url}")
+        return "updated" if is_clean else "needs review", pull_url
 
 
 @click.command()
@@ -135,6 +553,19 @@ def _create_or_update_github_pr(
     help='Should match the format "org/repo#branch. Repeat for each repo',
 )
 @click.option("--github-auth-token", required=True, help="GitHub Token to create PRs")
+@click.option(
+    "--github-api-url",
+    default="https://api.github.com",
+    show_default=True,
+    envvar="GITHUB_API_URL",
+    help="Base URL of the GitHub REST API",
+)
+@click.option(
+    "--graphql/--no-graphql",
+    default=True,
+    show_default=True,
+    help="Look up the existing pull requests of all repos in a single GraphQL query",
+)
 @click.option(
     "--pull-request-body-template",
     default=os.path.join(
@@ -143,101 +574,92 @@ def _create_or_update_github_pr(
     ),
     help="Template file to use for pull request template",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of repositories to update concurrently",
+)
+@click.option(
+    "--cache-dir",
+    default=DEFAULT_CACHE_DIR,
+    show_default=True,
+    help="Directory of the git mirrors and of the GitHub response cache",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Make blobless clones instead of using the mirrors in --cache-dir",
+)
+@click.option(
+    "--template-version",
+    help="Template tag or commit to update to, the latest tag by default",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Clone and update repositories already on the template version",
+)
 def main(
     repo: typing.List[RepositoryRef],
     github_auth_token: str,
+    github_api_url: str,
+    graphql: bool,
     pull_request_body_template: str,
+    jobs: int,
+    cache_dir: str,
+    no_cache: bool,
+    template_version: str | None,
+    force: bool,
 ):
-    results = []
-
-    for current_repo in repo:
-        _logger.info("Working on %s", current_repo)
-
-        copier_branch = f"{current_repo.branch}-copier"
-
-        with with_temporary_clone(current_repo):
-            if not os.path.exists(".copier-answers.yml"):
-                _logger.warning(
-                    f" - skipping {current_repo} because it has no .copier-answers.yml"
-                )
-                continue
-
-            with open(".copier-answers.yml", "r") as answers:
-                answers = yaml.safe_load(answers.read())
-                copier_version_before = answers.get("_commit", "unknown")
-                copier_template_url = answers.get("_src_path", "unknown")
-
-            subprocess.check_call(["git", "checkout", "-B", copier_branch])
-
-            r = subprocess.call(["copier", "update", "--defaults", "--trust"])
-            if r != 0:
-                _logger.error(f" - copier update failed on {current_repo}")
-                continue
-
-            is_clean = False
-
-            # 3 attempts for a clean run is ideal
-            for _ in range(3):
-                # make sure we've added any files which may have been modified
-                subprocess.check_call(["git", "add", "."])
-                r = subprocess.call(["pre-commit", "run", "-a"])
-                if r == 0:
-                    is_clean = True
-                    break
-
-            # Make sure we've definitely got everything
-            if not is_clean:
-                subprocess.check_call(["git", "add", "."])
-
-            # Are there any differences?
-            r = subprocess.call(["git", "diff", "--cached", "--quiet", "--exit-code"])
-            if r == 0:
-                # No, continue
-                _logger.warn(f" - skipping {current_repo}, no changes pending")
-                continue
-
-            commit_cmd = [
-                "git",
-                "commit",
-                "-m",
-                "ci: copier update",
-            ]
-            if not is_clean:
-                commit_cmd.append("--no-verify")
-
-            with open(".copier-answers.yml", "r") as answers:
-                copier_version_after = yaml.safe_load(answers.read()).get(
-                    "_commit", "unknown"
-                )
-
-            # Push to GitHub
-            subprocess.check_call(commit_cmd)
-            subprocess.check_call(["git", "push", "-f", "-u", "origin", copier_branch])
+    client = GitHubClient(
+        github_auth_token,
+        base_url=github_api_url,
+        cache_dir=os.path.join(cache_dir, ".http"),
+        pool_size=jobs,
+    )
+    existing_pulls = {}
+    if graphql:
+        try:
+            existing_pulls = client.find_pull_requests(
+                repo, lambda current_repo: f"{current_repo.branch}-copier"
+            )
+        except requests.RequestException as e:
+            _logger.warning("Batched pull request lookup failed: %s", e)
 
-            # Create pull request
-            pull_url = _create_or_update_github_pr(
-                github_auth_token,
-                copier_branch,
+    def update(current_repo):
+        start = time.monotonic()
+        try:
+            skip = None
+            if not force:
+                skip = _preflight(client, current_repo, template_version)
+            outcome, detail = skip or _update_repository(
                 current_repo,
-                title=f"ci: copier template update {copier_version_before} to {copier_version_after}",
-                body=_render_template(
-                    pull_request_body_template,
-                    copier_template_url=copier_template_url,
-                    copier_version_before=copier_version_before,
-                    copier_version_after=copier_version_after,
-                    is_clean=is_clean,
-                    now=datetime.datetime.now(),
-                    current_repo=current_repo,
-                ),
+                client,
+                pull_request_body_template,
+                None if no_cache else cache_dir,
+                template_version,
+                existing_pulls.get(current_repo, False),
             )
+        except Exception as e:
+            _logger.exception("Failed to update %s", _label(current_repo))
+            outcome, detail = "error", str(e)
+        return current_repo, outcome, detail, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(update, repo))
+
+    width = max(len(_label(current_repo)) for current_repo in repo)
+    click.echo(f"\n{'repository':<{width}}  {'outcome':<12} {'duration':>9}  details")
+    for current_repo, outcome, detail, duration in results:
+        click.echo(
+            f"{_label(current_repo):<{width}}  {outcome:<12} {duration:>8.1f}s  {detail}"
+        )
 
-            if pull_url:
-                completion_msg = f"Created/Updated PR for {current_repo} - {pull_url}"
-                _logger.info(completion_msg)
-                results.append(completion_msg)
-
-        for i in results:
-            _logger.info(i)
+    if any(outcome in ("failed", "error") for _, outcome, _, _ in results):
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":